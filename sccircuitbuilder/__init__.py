@@ -1 +1,4 @@
-from sccircuitbuilder.circuitbuilder import GUI
\ No newline at end of file
+def GUI():
+    #Qt is only imported when the GUI is started, the circuit model runs without it
+    from sccircuitbuilder.circuitbuilder import GUI
+    GUI()
@@ -0,0 +1,155 @@
+"""Linear circuit matrices and normal modes, without a round-trip through scQubits.
+
+Element values are read as scQubits reads the export: capacitors and
+inductors give their charging energy C and inductive energy L, junctions
+EJ and EC. In node phases, with ground dropped, a branch between nodes a
+and b adds its weight at (a, a) and (b, b) and subtracts it at (a, b) and
+(b, a): 1/(8 EC) in the capacitance matrix, the inductive energy in the
+inverse inductance matrix. Junctions count as inductors of energy EJ, so
+the normal modes are the small oscillations of the circuit, with
+frequencies in the units of the energies.
+
+Matrices are dense numpy arrays, or scipy.sparse arrays with sparse = True
+when scipy is installed.
+"""
+import numpy as np
+
+try:
+    from scipy import sparse as sp
+    from scipy.sparse.linalg import eigsh
+except ImportError:
+    sp = None
+
+#property with the charging and the inductive energy of each element type
+CHARGING = {"C": "C", "JJ": "EC"}
+INDUCTIVE = {"L": "L", "JJ": "EJ"}
+
+def branches(circuit):
+    """Names, {property: value} and node numbers (m by 2, ground is 0) of the elements, in uid order."""
+    circuit.number_nodes()
+    rows = {
+        element.uid: (element.name, element.properties, (element.nodes[0]._idx, element.nodes[1]._idx))
+        for element in circuit.elements
+    }
+    source = circuit.source
+    if source:
+        #unbuilt elements of a mapped file are read from its arrays
+        uids, numbers = source.terminal_numbers()
+        for uid, nodes in zip(uids.tolist(), numbers.tolist()):
+            rows[uid] = (*source.branch(uid), nodes)
+    rows = [rows[uid] for uid in sorted(rows)]
+    names = [row[0] for row in rows]
+    properties = [row[1] for row in rows]
+    ends = np.array([row[2] for row in rows], dtype = int).reshape(-1, 2)
+    return names, properties, ends
+
+def node_count(circuit):
+    """Number of nodes, not counting ground."""
+    circuit.number_nodes()
+    n = circuit.source.alive_nodes() if circuit.source else 0
+    return max([n] + [node._idx for node in circuit.nodes])
+
+def _energies(names, properties, table):
+    #energy of each element with an entry in table, nan for the others
+    energies = np.full(len(names), np.nan)
+    for i, (name, values) in enumerate(zip(names, properties)):
+        key = table.get(name)
+        if key is None:
+            continue
+        try:
+            energies[i] = float(values[key])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"{name} element without a numeric {key}") from None
+        if not energies[i] > 0:
+            raise ValueError(f"{name} element with {key} = {values[key]}, must be positive")
+    return energies
+
+def _assemble(ends, weights, n, sparse):
+    #sum the contributions of the branches with a weight, dropping the rows and columns of ground
+    keep = ~np.isnan(weights)
+    a, b, w = ends[keep, 0]-1, ends[keep, 1]-1, weights[keep]
+    rows = np.concatenate([a, b, a, b])
+    cols = np.concatenate([a, b, b, a])
+    data = np.concatenate([w, w, -w, -w])
+    inside = (rows >= 0) & (cols >= 0)
+    return _matrix(rows[inside], cols[inside], data[inside], (n, n), sparse)
+
+def _matrix(rows, cols, data, shape, sparse):
+    #duplicate entries are summed
+    if sparse:
+        if sp is None:
+            raise ImportError("sparse matrices need scipy")
+        return sp.csr_array((data, (rows, cols)), shape = shape)
+    flat = np.bincount(rows*shape[1]+cols, data, minlength = shape[0]*shape[1])
+    return flat.reshape(shape)
+
+def _branch_energies(circuit):
+    names, properties, ends = branches(circuit)
+    n = node_count(circuit)
+    charging = _energies(names, properties, CHARGING)
+    inductive = _energies(names, properties, INDUCTIVE)
+    return ends, charging, inductive, n
+
+def _components(ends, n):
+    #smallest node of the part of each node 0..n joined by the branches, by union-find
+    parent = list(range(n+1))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for a, b in ends.tolist():
+        a, b = root(a), root(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    return np.array([root(i) for i in range(n+1)], dtype = int)
+
+def capacitance_matrix(circuit, sparse = False):
+    ends, charging, _, n = _branch_energies(circuit)
+    return _assemble(ends, 1/(8*charging), n, sparse)
+
+def inverse_inductance_matrix(circuit, sparse = False):
+    ends, _, inductive, n = _branch_energies(circuit)
+    return _assemble(ends, inductive, n, sparse)
+
+def junction_incidence(circuit, sparse = False):
+    """Junctions by nodes, +1 at the first node of a junction and -1 at the second."""
+    names, _, ends = branches(circuit)
+    ends = ends[np.array([name == "JJ" for name in names], dtype = bool)]
+    j = np.arange(len(ends))
+    rows = np.concatenate([j, j])
+    cols = np.concatenate([ends[:, 0], ends[:, 1]])-1
+    data = np.repeat([1., -1.], len(ends))
+    inside = cols >= 0
+    return _matrix(rows[inside], cols[inside], data[inside], (len(ends), node_count(circuit)), sparse)
+
+def normal_modes(circuit, k = None):
+    """Frequencies of the normal modes, lowest first, only the k lowest if given.
+
+    Parts of the circuit with no inductive path to ground give modes of
+    frequency 0, islands with no capacitance to ground give none. With k,
+    large circuits are solved as sparse matrices when scipy is installed.
+    """
+    ends, charging, inductive, n = _branch_energies(circuit)
+    #an island without capacitance to ground moves freely as a whole, fixing one
+    #of its nodes to ground removes that motion and leaves the other modes as they are
+    capacitive = _components(ends[~np.isnan(charging)], n)
+    pinned = ends[~np.isnan(inductive)]
+    crossing = capacitive[pinned[:, 0]] != capacitive[pinned[:, 1]]
+    if crossing.any():
+        island = max(capacitive[pinned[crossing]].ravel().tolist())
+        raise ValueError(f"no capacitance to ground at node {island}")
+    keep = np.flatnonzero(capacitive[1:] != np.arange(1, n+1))
+    sparse = sp is not None and k is not None and k < len(keep)-1
+    capacitance = _assemble(ends, 1/(8*charging), n, sparse)[keep][:, keep]
+    inductance = _assemble(ends, inductive, n, sparse)[keep][:, keep]
+    if sparse:
+        #shift-invert just below 0 finds the lowest modes, including those at 0
+        squares = eigsh(inductance.tocsc(), k, M = capacitance.tocsc(), sigma = -1, return_eigenvectors = False)
+    else:
+        lower = np.linalg.cholesky(capacitance)
+        squares = np.linalg.eigvalsh(np.linalg.solve(lower, np.linalg.solve(lower, inductance).T))[:k]
+    #rounding leaves modes at 0 slightly off, in either direction
+    squares = np.sort(squares)
+    squares[squares < 1e-12*np.abs(squares).max(initial = 0)] = 0
+    return np.sqrt(squares)
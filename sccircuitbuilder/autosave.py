@@ -0,0 +1,202 @@
+"""Autosave and crash recovery.
+
+The circuit is saved as a checkpoint of its records, and every state change
+after that is appended to a journal. Both are written by a background
+thread, the GUI thread only hands over objects that are never changed again:
+the deltas given to the caretaker and a copy of its state. After a crash the
+session is rebuilt by replaying the journal onto the checkpoint.
+
+Each running session writes to its own directory and holds a lock on it
+until it exits, so sessions running side by side leave each other's files
+alone. A directory whose lock is free belongs to a session that crashed, it
+is kept until it is recovered or discarded.
+"""
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import numpy as np
+from sccircuitbuilder.caretaker import apply
+
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+    fcntl = None
+
+AUTOSAVE_DIR = os.path.join(os.path.expanduser("~"), ".sccircuitbuilder", "autosave")
+SESSION_PREFIX = "session-"
+LOCK = "lock"
+CHECKPOINT = "checkpoint.pickle"
+JOURNAL = "journal.pickle"
+
+def _lock(directory):
+    #lock of a session directory, None if a running session holds it; the OS releases it when a session dies
+    f = open(os.path.join(directory, LOCK), "a+b")
+    try:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def _remove(directory, lock):
+    lock.close() #files that are open cannot be removed on every platform
+    shutil.rmtree(directory, ignore_errors = True)
+
+class Autosave:
+
+    def __init__(self, directory = AUTOSAVE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+        self.session = tempfile.mkdtemp(prefix = SESSION_PREFIX, dir = directory)
+        self._lock = _lock(self.session)
+        self.changes = 0 #journal entries since the last checkpoint
+        self._queue = queue.Queue()
+        self._generation = 0
+        self._journal = None
+        self._broken = False #a write failed, deltas are dropped until a checkpoint is written
+        self._error = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _path(self, name):
+        return os.path.join(self.session, name)
+
+    def journal(self, delta):
+        """Record a change of state, the delta must not be modified afterwards."""
+        if delta:
+            self.changes += 1
+            self._queue.put(("delta", delta))
+
+    def checkpoint(self, state, source = None):
+        """Save a state of {uid: record}, plus the unbuilt objects of a MappedCircuit."""
+        alive = source.alive.copy() if source else None
+        self.changes = 0
+        self._queue.put(("checkpoint", dict(state), source, alive))
+
+    def flush(self):
+        #wait until everything handed over so far is on disk, or failed to be written
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def failure(self):
+        """The error that stopped autosaving since the last call, or None."""
+        error, self._error = self._error, None
+        return error
+
+    def close(self):
+        """Stop the worker and remove the files, the session ended normally."""
+        self._queue.put(None)
+        self._thread.join()
+        _remove(self.session, self._lock)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                if self._journal:
+                    self._journal.close()
+                self._queue.task_done()
+                return
+            try:
+                if item[0] == "delta":
+                    #a journal that missed a delta cannot be replayed, the next checkpoint starts a new one
+                    if not self._broken:
+                        pickle.dump(item[1], self._journal)
+                        self._journal.flush()
+                else:
+                    self._write_checkpoint(*item[1:])
+                    self._broken = False
+            except Exception as e:
+                #disk full, permissions...: the worker keeps running and tries again at the next checkpoint
+                if not self._broken:
+                    self._error = e
+                self._broken = True
+            finally:
+                self._queue.task_done()
+
+    def _write_checkpoint(self, state, source, alive):
+        if source:
+            #objects of the mapped file that were never edited are read from its rows
+            for uid in (source.base + np.flatnonzero(alive)).tolist():
+                if not uid in state:
+                    state[uid] = source.record(uid)
+        self._generation += 1
+        temp = self._path(CHECKPOINT+".tmp")
+        with open(temp, "wb") as f:
+            pickle.dump((self._generation, state), f)
+        os.replace(temp, self._path(CHECKPOINT))
+        #the journal names its checkpoint, one left from before this point is ignored
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self._path(JOURNAL), "wb")
+        pickle.dump(self._generation, self._journal)
+        self._journal.flush()
+
+    def _crashed(self):
+        #directories of other sessions that have a checkpoint, newest first; running ones are skipped by their lock
+        sessions = []
+        for name in os.listdir(self.directory):
+            directory = os.path.join(self.directory, name)
+            if not name.startswith(SESSION_PREFIX) or directory == self.session:
+                continue
+            if os.path.exists(os.path.join(directory, CHECKPOINT)):
+                sessions.append(directory)
+            else:
+                #crashed before its first checkpoint, nothing to recover
+                lock = _lock(directory)
+                if lock:
+                    _remove(directory, lock)
+        return sorted(sessions, key = lambda directory: os.path.getmtime(os.path.join(directory, CHECKPOINT)), reverse = True)
+
+    def _claim(self):
+        #lock of the newest crashed session, taken so that no other session recovers it as well
+        for directory in self._crashed():
+            lock = _lock(directory)
+            if lock:
+                return directory, lock
+        return None, None
+
+    def recoverable(self):
+        directory, lock = self._claim()
+        if lock:
+            lock.close()
+        return directory is not None
+
+    def recover(self):
+        """State of the last session that did not exit normally, or None. Its files are removed."""
+        directory, lock = self._claim()
+        if directory is None:
+            return None
+        with open(os.path.join(directory, CHECKPOINT), "rb") as f:
+            generation, state = pickle.load(f)
+        if os.path.exists(os.path.join(directory, JOURNAL)):
+            with open(os.path.join(directory, JOURNAL), "rb") as f:
+                for delta in _entries(f, generation):
+                    apply(state, delta)
+        _remove(directory, lock)
+        return state
+
+    def discard(self):
+        """Remove the files of every session that did not exit normally."""
+        while True:
+            directory, lock = self._claim()
+            if directory is None:
+                return
+            _remove(directory, lock)
+
+def _entries(f, generation):
+    try:
+        if pickle.load(f) != generation:
+            return
+        while True:
+            yield pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):
+        #the last entry may have been cut short by the crash
+        return
@@ -4,31 +4,44 @@ from sccircuitbuilder.node import Node, Ground
 from sccircuitbuilder.connection import Connection
 import numpy as np
 import os
-from pathlib import Path
-from PySide6.QtGui import QIcon, QTransform, QPen, QColorConstants, QAction
-from PySide6.QtWidgets import (
-    QToolBar, 
-    QWidget, 
-    QLabel, 
-    QLineEdit, 
-    QHBoxLayout, 
-    QSpacerItem, 
-    QSizePolicy, 
-)
+
+#name -> icon and default properties of the elements in the toolbox
+ELEMENT_TYPES = {
+    "C": ("elements/capacitor.svg", {"C": .02}),
+    "JJ": ("elements/JJ.svg", {"EC": 1.2, "EJ": 21}),
+    "L": ("elements/Inductor.svg", {"L": 1.2}),
+}
+
+def export_line(name, nodes, values):
+    #one branch of the exported circuit: name, the two terminal nodes and the property values
+    values = ",".join(f"{value}" for value in values)
+    return f"- [{name},{nodes[0]},{nodes[1]},{values}]"
+
+def label_extent(properties):
+    #width and height of the "key = value" labels painted above and to the right of an element
+    lines = [f"{key} = {value}" for key, value in properties]
+    return max(map(len, lines), default = 0)*CHAR_WIDTH, len(lines)*LABEL_LINE
 
 class BranchElement(CanvasElement):
 
-    def __init__(self, point, circuit, handle_distance = 1):
+    def __init__(self, point, circuit, handle_distance = 1, handles = True):
+        #the loader passes handles = False and attaches the saved nodes and wiring itself
 
         super().__init__(point.snaptogrid())
 
         self.properties = {}
-        handle_disp = Point(handle_distance, 0)
         self.nodes = []
-        self.nodes.append(Node(Point(-SPACING,0)-SPACING*handle_disp+point.snaptogrid(), circuit))
-        self.nodes.append(Node(Point(SPACING,0)+SPACING*handle_disp+point.snaptogrid(), circuit))
-
         self.connections = []
+        if handles:
+            self._add_handles(point.snaptogrid(), circuit, Point(handle_distance, 0))
+
+        self.circuit = circuit
+        self.circuit.add_element(self)
+
+    def _add_handles(self, point, circuit, handle_disp):
+        self.nodes.append(Node(Point(-SPACING,0)-SPACING*handle_disp+point, circuit))
+        self.nodes.append(Node(Point(SPACING,0)+SPACING*handle_disp+point, circuit))
+
         self.connections.append(Connection(self, self.nodes[0], -1*handle_disp, circuit))
         self.connections.append(Connection(self, self.nodes[1], handle_disp, circuit))
 
@@ -38,50 +51,54 @@ class BranchElement(CanvasElement):
         for node in self.nodes:
             node.elements.append(self)
 
-        self.disps = []
-        self.circuit = circuit
-        self.circuit.add_element(self)
-
 
     def __str__(self):
-        props_rep = []
-        for prop in self.properties:
-            props_rep.append(f"{self.properties[prop]},")
-        props_string = "".join(props_rep)
-        props_string = props_string[:-1]
-        return f"- [{self.name},{self.nodes[0].idx},{self.nodes[1].idx},{props_string}]"
-
-    def paint(self, painter):
-        painter.setPen(QPen(QColorConstants.Black, 3))
-        for i, prop in enumerate(self.properties):
-            painter.drawText(int(SPACING/2+self.x), int(self.y-SPACING/2-i*FONTSIZE*1.5), str(prop) + " = "+str(self.properties[prop]))
-        
-        width = self.bbox.width
-        height = self.bbox.height
-        if self.rot % 2== 0:
-            disp = [SPACING, 0]
-        else:
-            disp = [0,SPACING]
-        painter.drawPixmap(int(self.x-width/2-disp[0]/2), int(self.y-height/2-disp[1]/2), int(width+disp[0]), int(height+disp[1]), self.icon)
-
-    def in_bbox(self,point):
-        self.disps.clear()
+        return export_line(self.name, [node.idx for node in self.nodes[:2]], self.properties.values())
+
+    def paint_rects(self):
+        #icon with its leads, and the property labels above and to the right
+        width = self.bbox.width + SPACING*(self.rot % 2 == 0)
+        height = self.bbox.height + SPACING*(self.rot % 2 == 1)
+        label_width, label_height = label_extent(self.properties.items())
+        return [
+            Rect(self.x-width/2, self.y-height/2, self.x+width/2, self.y+height/2),
+            Rect(self.x, self.y-SPACING/2-label_height, self.x+SPACING/2+label_width, self.y),
+        ]
+
+    def attached(self):
+        attached = self.nodes + self.connections
         for node in self.nodes:
-            self.disps.append(Point(node.x-self.x, node.y-self.y))
-        return super().in_bbox(point)
+            attached += node.connections
+        return attached
+
+    def follows(self, node): #free nodes are carried along when the element moves
+        self.circuit.complete(node)
+        return len(node.elements) == 1 and all([len(conn.anchors)==0 for conn in node.connections])
 
     def drag(self, point):
-        for obj in self.circuit:
-            if obj.in_bbox(point.snaptogrid()) and not obj is self:
+        #coalesced mouse moves can jump onto the element's own handles, which move with it
+        target = point.snaptogrid()
+        moving = [self] + self.connections + [node for node in self.nodes if self.follows(node)]
+        for obj in self.circuit.index.at(target):
+            if not obj in moving and obj.in_bbox(target):
                 return
+        disps = [Point(node.x-self.x, node.y-self.y) for node in self.nodes]
         super().drag(point)
-        for node,disp in zip(self.nodes,self.disps):
-            if len(node.elements) == 1 and all([len(conn.anchors)==0 for conn in node.connections]):
+        for node,disp in zip(self.nodes,disps):
+            if self.follows(node):
                 node.drag(Point(self.x, self.y) + disp)
+        for connection in self.connections:
+            connection.rewire()
     
+    def set_type(self, name):
+        icon, defaults = ELEMENT_TYPES[name]
+        self.name = name
+        self.properties.update(defaults)
+        self.setIcon(os.path.join(os.path.dirname(__file__), icon), SPACING, SPACING)
+
     def setIcon(self, path, width, height):
         self.icon_path = path
-        self.icon = QIcon(path).pixmap(width*IMG_RES_FACTOR, height*IMG_RES_FACTOR)
+        self.icon_size = (width*IMG_RES_FACTOR, height*IMG_RES_FACTOR)
         self.bbox = Bbox(width, height)
 
     def rotate(self):
@@ -91,55 +108,40 @@ class BranchElement(CanvasElement):
             connection.reorient()
                
         for node in self.nodes:
-            if len(node.elements) == 1 and all([len(conn.anchors)==0 for conn in node.connections]):
+            if self.follows(node):
                 node.x -= self.x
                 node.y -= self.y
                 (node.x,node.y) = np.array([node.x, node.y]) @ np.array([[0,-1],[1,0]])
                 node.x += self.x
                 node.y += self.y
                 node.rotate()
+                node.reindex()
+                for connection in node.connections:
+                    connection.rewire()
     
     def rotate_icon(self):
         super().rotate() 
-        rotatemat = QTransform() 
-        rotatemat.rotate(-90)
-        self.icon = self.icon.transformed(rotatemat)
         w,h = self.bbox.width, self.bbox.height
         self.bbox = Bbox(h,w) 
+        self.circuit.reindex(self)
         
-    def toolbar(self, update):
-        toolbar = QToolBar()
-        def rotateandupdate():
-            self.rotate()
-            update()
-        rotate = QAction("",toolbar)
-
-        here = Path(__file__).parent
-        rotate.setIcon(QIcon(os.path.join(os.path.dirname(__file__), "icons/rotate")))
-        rotate.triggered.connect(rotateandupdate)
-        toolbar.addAction(rotate)
-
-        delete = QAction("",toolbar)
-        delete.setIcon(QIcon(os.path.join(os.path.dirname(__file__), "icons/trash")))
-        def deleteandupdate():
-            self.delete()
-            update()
-        delete.triggered.connect(deleteandupdate)
-        toolbar.addAction(delete)
-
-        for prop in self.properties:
-            propedit = PropEdit(prop, self.properties, update) 
-            toolbar.addWidget(propedit)
-
-        spacer = QWidget()
-        spacer.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Ignored)
-        toolbar.addWidget(spacer)
-
-        return toolbar
-    
     def delete(self):
         self.circuit.remove_element(self)
 
+    def record(self):
+        #plain tuple describing the element, its terminals and its wiring
+        return (
+            "element", 
+            self.name, 
+            self.icon_path, 
+            int(self.x), 
+            int(self.y), 
+            self.rot, 
+            tuple(self.properties.items()), 
+            tuple(node.uid for node in self.nodes), 
+            tuple(connection.record() for connection in self.connections), 
+        )
+
     class ElementMomento:
         def __init__(self, element):
             self.nodes = []
@@ -160,62 +162,18 @@ class BranchElement(CanvasElement):
         
 class Capacitor(BranchElement):
 
-
     def __init__(self, point, circuit):
         super().__init__(point, circuit)
-        self.name = "C"
-        self.C = .02
-        self.properties["C"] = self.C
-        self.icon_path =  "elements/capacitor.svg"
-        self.setIcon(os.path.join(os.path.dirname(__file__), self.icon_path), SPACING, SPACING)
+        self.set_type("C")
 
 class JosephsonJunction(BranchElement):
 
-
     def __init__(self, point, circuit):
         super().__init__(point, circuit)
-        self.name = "JJ"
-        self.EJ = 21
-        self.EC = 1.2
-        self.properties["EC"] = self.EC
-        self.properties["EJ"] = self.EJ
-        self.icon_path = "elements/JJ.svg"
-        self.setIcon(os.path.join(os.path.dirname(__file__), self.icon_path), SPACING, SPACING)
+        self.set_type("JJ")
 
 class Inductor(BranchElement):
 
     def __init__(self, point, circuit):
         super().__init__(point, circuit)
-        self.name = "L"
-        self.L = 1.2
-        self.properties["L"] = self.L
-        self.icon_path = "elements/Inductor.svg"
-        self.setIcon(os.path.join(os.path.dirname(__file__), self.icon_path), SPACING, SPACING)
-
-class PropEdit(QWidget):
-    def __init__(self, key, properties, update):
-        super().__init__()
-        self.key = key
-        self.properties = properties
-        self.update = update
-        self.initGui()
-    
-    def initGui(self):
-        layout = QHBoxLayout()
-        self.setLayout(layout)
-        layout.addWidget(QLabel(self.key))
-        propedit = QLineEdit(str(self.properties[self.key]))
-        propedit.setMaximumWidth(70)
-        propedit.editingFinished.connect(self.update)
-        def textchange(text):
-            self.properties[self.key] = text
-        propedit.textChanged.connect(textchange)
-        layout.addWidget(propedit)
-        layout.addSpacerItem(QSpacerItem(
-            0,
-            0,
-            QSizePolicy.Policy.Expanding,
-            QSizePolicy.Policy.Ignored
-        ))
-    
-
+        self.set_type("L")
@@ -1,11 +1,16 @@
 from PySide6.QtWidgets import QFrame, QApplication
-from PySide6.QtGui import QColorConstants, QTransform, QPen, QPainter, QBrush, QNativeGestureEvent, QInputDevice
-from PySide6.QtCore import Qt
+from PySide6.QtGui import QColorConstants, QColor, QTransform, QPen, QPainter, QBrush, QNativeGestureEvent, QInputDevice, QPixmap
+from PySide6.QtCore import Qt, QLineF, QTimer
+from math import floor, ceil
+import numpy as np
 
 from sccircuitbuilder.circuit import Circuit
 from sccircuitbuilder.constants import *
 from sccircuitbuilder.node import Ground
 from sccircuitbuilder.branch_element import Capacitor, Inductor, JosephsonJunction, BranchElement
+from sccircuitbuilder.tile_cache import TileCache
+from sccircuitbuilder import painting
+from sccircuitbuilder.painting import BGCOLOR
 
 class SmartCanvas(QFrame):
     
@@ -20,6 +25,7 @@ class SmartCanvas(QFrame):
         #world transform and put origin at center of screen
         self._transform = QTransform()
         self._transform.translate(self.width()/2, self.height()/2)
+        self._inverse = None #inverse of _transform, recomputed after it changes
 
         self.objects = Circuit() #list of objects that can be clicked
         self.selected_object = None #object that is currently selected
@@ -35,12 +41,27 @@ class SmartCanvas(QFrame):
 
         self._mouse_button = None
 
+        #mouse moves are coalesced: at most one is processed per MOVE_INTERVAL
+        self._pending_move = None #latest unprocessed (position, buttons)
+        self._move_timer = QTimer(self)
+        self._move_timer.setSingleShot(True)
+        self._move_timer.setInterval(MOVE_INTERVAL)
+        self._move_timer.timeout.connect(self._flush_move)
+        self.dropped_moves = 0 #moves superseded by a later one before being processed
+
+        self._grid_key = None #cell range and level of the cached grid lines
+        self._grid_lines = ([], [])
+
+        self._tiles = TileCache() #cached rendering of everything that is not moving
+        self._live = set() #objects being dragged, painted on top of the cached tiles
+
     def world_point(self, event):
         return self.map(Point(event.pos().x(), event.pos().y()))
 
     def wheelEvent(self, event): #wheel scroll #for windows?
         if event.device().type() == QInputDevice.DeviceType.TouchPad:
             self._transform.translate(event.pixelDelta().x(), event.pixelDelta().y())
+            self._inverse = None
         else:
             self._zoomEvent(event.angleDelta().y(), event)
         self.update()
@@ -70,12 +91,7 @@ class SmartCanvas(QFrame):
         self.update()
 
     def object_under(self, point, skip = False, skip_obj = None):
-        for object in self.objects:
-            if skip and object is skip_obj:
-                continue
-            if object.in_bbox(point):
-                return object
-        return None
+        return self.objects.object_under(point, skip_obj if skip else None)
     
     def _zoom(self, center, direction):
         self._zoom_factor *= (1+direction*ZOOM_SPEED) #keep track of zoom amount
@@ -86,17 +102,33 @@ class SmartCanvas(QFrame):
             -center.y*direction*ZOOM_SPEED
             )
         self._transform.scale(1+direction*ZOOM_SPEED, 1+direction*ZOOM_SPEED)
+        self._inverse = None
         
 
     def paintEvent(self, event):
         self.painter.begin(self)
-        self.painter.setTransform(self._transform)
         self.painter.setRenderHint(QPainter.RenderHint.Antialiasing)
 
-        self._background()
-
-        for object in self.objects:
-            object.paint(self.painter)
+        viewport = self._viewport()
+        zoom = self._transform.m11()
+        #build the mapped objects on the tiles around the viewport
+        pad = self._tiles.tile_size/zoom
+        self.objects.materialise(Rect(viewport.left-pad, viewport.top-pad, viewport.right+pad, viewport.bottom+pad))
+        self.objects.number_nodes() #before the changes it causes are drained
+        if zoom != self._tiles.zoom: 
+            #zoom is changing, skip the cache until it settles
+            self._tiles.reset(zoom)
+            self.objects.paint_index.take_changes()
+            self.painter.setTransform(self._transform)
+            self._background(self.painter, viewport)
+            for object in self.objects.visible(viewport):
+                painting.paint(object, self.painter)
+        else:
+            self._paint_tiles(viewport)
+            self.painter.setTransform(self._transform)
+            for object in self.objects.visible(viewport):
+                if object in self._live:
+                    painting.paint(object, self.painter)
 
         if self.selected_group:
             self._selection_box()
@@ -117,14 +149,73 @@ class SmartCanvas(QFrame):
                     int(object.bbox.height)
                 )
 
-    def _background(self): #solid background with grid
-        painter = self.painter
-
-        width = self.width()
-        height = self.height()
-
-        start = self.map(ORIGIN)
-        stop = self.map(Point(width, height))
+    def _paint_tiles(self, viewport):
+        self._sync_tiles()
+        dx, dy = self._transform.dx(), self._transform.dy()
+        size = self._tiles.tile_size
+        for key in self._tiles.keys(viewport):
+            pixmap = self._tiles.get(key)
+            if pixmap is None:
+                pixmap = self._render_tile(key)
+                self._tiles.put(key, pixmap)
+            self.painter.drawPixmap(round(key[0]*size+dx), round(key[1]*size+dy), pixmap)
+
+    def _sync_tiles(self): #drop tiles showing objects that changed since the last frame
+        index = self.objects.paint_index
+        changes = index.take_changes()
+        if changes is None:
+            self._tiles.clear()
+            return
+        for object, cells in changes:
+            if object in self._live:
+                continue
+            for cell in cells:
+                self._tiles.invalidate(index.cell_rect(cell))
+
+    def _render_tile(self, key):
+        zoom = self._tiles.zoom
+        size = self._tiles.tile_size
+        ratio = self.devicePixelRatioF()
+        pixmap = QPixmap(ceil(size*ratio), ceil(size*ratio))
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(BGCOLOR)
+
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setTransform(QTransform(zoom, 0, 0, zoom, -key[0]*size, -key[1]*size))
+        rect = self._tiles.world_rect(key)
+        self._background(painter, rect)
+        for object in self.objects.visible(rect):
+            if not object in self._live:
+                painting.paint(object, painter)
+        painter.end()
+        return pixmap
+
+    def _start_live(self, objects): #paint objects on top of the tiles while they move
+        self._live.clear()
+        for object in objects:
+            self._live.add(object)
+            self._live.update(object.attached())
+        self._invalidate_live()
+
+    def _end_live(self):
+        self._invalidate_live()
+        self._live.clear()
+
+    def _invalidate_live(self):
+        index = self.objects.paint_index
+        for object in self._live:
+            if object in index:
+                for cell in index.entries[object][1]:
+                    self._tiles.invalidate(index.cell_rect(cell))
+
+    def _viewport(self): #visible area in world coordinates
+        (left, top), (right, bottom) = self.map_array(np.array([[0, 0], [self.width(), self.height()]]))
+        return Rect(left, top, right, bottom)
+
+    def _background(self, painter, viewport): #solid background with grid
+        start = Point(floor(viewport.left), floor(viewport.top))
+        stop = Point(ceil(viewport.right), ceil(viewport.bottom))
 
         painter.fillRect(
             int(start.x),
@@ -133,48 +224,102 @@ class SmartCanvas(QFrame):
             int(stop.y-start.y), 
             BGCOLOR)
 
-        painter.setPen(QPen(QColorConstants.LightGray, 1))
-        for i in range(round(start.x/SPACING),round(stop.x/SPACING)+1):
-            painter.drawLine(int((i+.5)*SPACING), int(start.y), int((i+.5)*SPACING), int(stop.y))
-
-        for j in range(round(start.y/SPACING), round(stop.y/SPACING)+1):
-            painter.drawLine(int(start.x), int((j+.5)*SPACING), int(stop.x), int((j+.5)*SPACING))
+        step, fade = grid_level(painter.worldTransform().m11())
+        major, minor = self._grid(start, stop, step)
 
+        painter.setPen(QPen(QColorConstants.LightGray, 1))
+        painter.drawLines(major)
+        if fade > 0 and minor:
+            color = QColor(QColorConstants.LightGray)
+            color.setAlphaF(fade)
+            painter.setPen(QPen(color, 1))
+            painter.drawLines(minor)
+
+    def _grid(self, start, stop, step): #grid lines covering the given area, batched for drawLines
+        i0, i1 = round(start.x/SPACING), round(stop.x/SPACING)
+        j0, j1 = round(start.y/SPACING), round(stop.y/SPACING)
+        key = (i0, i1, j0, j1, step)
+        if key == self._grid_key:
+            return self._grid_lines
+
+        top, bottom = (j0-.5)*SPACING, (j1+.5)*SPACING
+        left, right = (i0-.5)*SPACING, (i1+.5)*SPACING
+        major, minor = [], []
+        for i in range(i0 - i0 % step, i1+1, step):
+            lines = major if i % (2*step) == 0 else minor
+            lines.append(QLineF((i+.5)*SPACING, top, (i+.5)*SPACING, bottom))
+        for j in range(j0 - j0 % step, j1+1, step):
+            lines = major if j % (2*step) == 0 else minor
+            lines.append(QLineF(left, (j+.5)*SPACING, right, (j+.5)*SPACING))
+
+        self._grid_key = key
+        self._grid_lines = (major, minor)
+        return self._grid_lines
+
+
+    def _inverted(self):
+        if self._inverse is None:
+            self._inverse,_ = self._transform.inverted()
+        return self._inverse
 
     def map(self, point): #map device coordinates to world coordinates
-        inverse_transform,_ = self._transform.inverted()
-        return Point(*inverse_transform.map(point.x, point.y))
+        return Point(*self._inverted().map(point.x, point.y))
+
+    def map_array(self, points): #map an (n, 2) array of device coordinates to world coordinates
+        return transform_array(self._inverted(), points)
     
     def mouseMoveEvent(self, event) -> None: #TODO: how to detect trackpad?
-        mouseloc = self.world_point(event) 
-        if event.buttons() == Qt.MouseButton.LeftButton: #left button drag
+        if self._pending_move:
+            self.dropped_moves += 1
+        self._pending_move = (Point(event.pos().x(), event.pos().y()), event.buttons())
+        if not self._move_timer.isActive():
+            self._flush_move()
+
+    def _flush_move(self): #process the latest mouse move and open a new frame
+        if not self._pending_move:
+            return
+        pos, buttons = self._pending_move
+        self._pending_move = None
+        self._move_timer.start()
+
+        mouseloc = self.map(pos) 
+        if buttons == Qt.MouseButton.LeftButton: #left button drag
             if self.selected_object:
-                self._dragging = True
+                if not self._dragging:
+                    self._dragging = True
+                    self._start_live(self._moving_objects())
                 self._drag(mouseloc)
             else:
-                self._pan(event)
-        elif event.buttons() == Qt.MouseButton.RightButton:
+                self._pan(pos)
+        elif buttons == Qt.MouseButton.RightButton:
             self.selected_group.selecting = True
             self.selected_group.drag(mouseloc)
 
         self.update()
     
+    def _moving_objects(self):
+        if len(self.selected_group) > 1:
+            return list(self.selected_group)
+        return [self.selected_object]
+
     def _drag(self, point):
         if len(self.selected_group) > 1:
             self.selected_group.drag(point)
         elif self.selected_object:
             self.selected_object.drag(point)
 
-    def _pan(self, event):
+    def _pan(self, pos):
         #get mouse displacement in world coordinates
-        displacement = Point(event.pos().x(), event.pos().y()) - self._displacement
+        displacement = pos - self._displacement
 
         #scale displacement relative to coordinate scaling and translate
         self._transform.translate(displacement.x/self._zoom_factor, displacement.y/self._zoom_factor)
+        self._inverse = None
         #update position to compute next displacement
         self._displacement += displacement
         
     def mousePressEvent(self, event) -> None:
+        self._flush_move()
         self._displacement = Point(event.pos().x(), event.pos().y())
         mouseloc = self.world_point(event) 
         if event.buttons() == Qt.MouseButton.LeftButton: #select object under mouse
@@ -196,6 +341,7 @@ class SmartCanvas(QFrame):
         self.selected_group.set_orig(mouseloc) #set left corner of selection box
        
     def mouseReleaseEvent(self,event):
+        self._flush_move()
         mouseloc = self.world_point(event)
         if self._mouse_button == Qt.MouseButton.LeftButton:
             self.leftButtonRelease(mouseloc)
@@ -206,6 +352,7 @@ class SmartCanvas(QFrame):
     def leftButtonRelease(self, mouseloc):
         if self._dragging:
             self.drop(mouseloc)
+            self._end_live()
         else:
             self.leftclick(mouseloc)
         self._dragging = False
@@ -217,12 +364,9 @@ class SmartCanvas(QFrame):
                 self.rightclick(mouseloc) 
 
     def drop(self, point):
-        for object in self.objects:
-            if object is self.selected_object:
-                continue
-            if object.in_bbox(point) and self.selected_object:
-                self.selected_object.drop(point, object)
-                break
+        object = self.object_under(point, True, self.selected_object)
+        if object and self.selected_object:
+            self.selected_object.drop(point, object)
         self.gui.take_snapshot()
         self.selected_object = None
 
@@ -266,7 +410,7 @@ class SmartCanvas(QFrame):
                     self.selected_group.clear()
                 self.gui.take_snapshot()
             try:
-                self.object_toolbar = object.toolbar(update_and_check)
+                self.object_toolbar = painting.toolbar(object, update_and_check)
                 self.gui.addToolBar(self.object_toolbar)
             except:
                 pass
@@ -311,13 +455,49 @@ class SmartCanvas(QFrame):
             self.selected_object.rotate()
             self.gui.take_snapshot()
     
-    def restore(self, memento):
-        try:
-            self.selected_group.clear()
-            self.objects.restore(memento)
-            self.update()
-        except:
-            pass
+    def open(self, fname):
+        from sccircuitbuilder import fileformat #only needed once a file is opened
+        #read into a new circuit first, a file that fails to load leaves the canvas as it was
+        loaded = Circuit()
+        fileformat.load(fname, loaded, lazy = True)
+        self.selected_group.clear()
+        self.objects.clear()
+        if loaded.source:
+            self.objects.map(loaded.source)
+        else:
+            self.objects.add_circuit(loaded)
+        self.update()
+
+    def recover(self, state):
+        self.selected_group.clear()
+        self.objects.clear()
+        self.objects.load_state(state)
+        self.load_options()
+        self.update()
+
+    def apply(self, delta):
+        #objects untouched by the delta keep their identity, so the selection survives
+        self.objects.apply(delta)
+        self.selected_group[:] = [obj for obj in self.selected_group if obj in self.objects.index]
+        self.load_options()
+        self.update()
+
+def transform_array(transform, points):
+    #apply the affine part of a QTransform to each row of points
+    matrix = np.array([
+        [transform.m11(), transform.m12()], 
+        [transform.m21(), transform.m22()]
+    ])
+    return np.asarray(points, dtype = float) @ matrix + [transform.dx(), transform.dy()]
+
+def grid_level(zoom):
+    #draw every step-th grid line so lines stay GRID_MIN_SPACING pixels apart,
+    #fading out the lines that disappear at the next coarser level
+    step = 1
+    while SPACING*step*zoom < GRID_MIN_SPACING:
+        step *= 2
+    fade = min(1, (SPACING*step*zoom-GRID_MIN_SPACING)/GRID_MIN_SPACING)
+    return step, fade
 
 class SelectedGroup(list):
     def __init__(self):
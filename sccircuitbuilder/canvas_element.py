@@ -1,24 +1,41 @@
 from sccircuitbuilder.constants import *
-from PySide6.QtGui import QColorConstants, QPen
+
+class UidCounter:
+    #uids identify objects across undo history, a mapped file reserves a block for its objects
+    def __init__(self):
+        self.next = 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        uid = self.next
+        self.next += 1
+        return uid
+
+    def reserve(self, n):
+        first = self.next
+        self.next += n
+        return first
+
+    def advance(self, uid):
+        #uids up to uid are in use, by objects loaded with their uids
+        self.next = max(self.next, uid+1)
+
+UIDS = UidCounter()
 
 class CanvasElement:
     
     def __init__(self, point):
+        self.uid = next(UIDS)
         self.x = point.x #int specifying x position on grid
         self.y = point.y #int specifying y position on grid
         self.rot = 0 #four different orientations
         self.bbox = Bbox(SPACING, SPACING)
 
-    def paint(self, painter):
-        color = QColorConstants.Black
-        if self.active:
-            color = QColorConstants.Red
-        pen = QPen(color, 3)
-        painter.setPen(pen)
-        painter.drawRect(int(self.x-self.width/2),int(self.y-self.width/2),SPACING,SPACING)
-
     def rotate(self):
         self.rot = (self.rot+1)%4
+        self.circuit.touch(self)
 
     def in_bbox(self, point):
         if not self.bbox:
@@ -28,9 +45,35 @@ class CanvasElement:
             return True
         return False
 
+    def hit_rects(self):
+        if not self.bbox:
+            return []
+        return [Rect(
+            self.x-self.bbox.width/2, 
+            self.y-self.bbox.height/2, 
+            self.x+self.bbox.width/2, 
+            self.y+self.bbox.height/2
+        )]
+
+    def paint_rects(self):
+        #area touched by paint, used to skip objects outside the view
+        return [Rect(self.x-SPACING/2, self.y-SPACING/2, self.x+SPACING/2, self.y+SPACING/2)]
+
+    def attached(self):
+        #objects that move or are redrawn along with this one
+        return []
+
+    def reindex(self):
+        self.circuit.reindex(self)
+
+    def record_owner(self):
+        #the object whose undo record describes this one
+        return self
+
     def drag(self, point):
         self.x = point.snaptogrid().x
         self.y = point.snaptogrid().y
+        self.reindex()
     
     def press(self, point):
         pass
@@ -1,33 +1,95 @@
+import sys
+
 class UndoRedoException(Exception):
     ...
 
+def apply(state, delta, reverse = False):
+    #carry a {key: record} state across a delta of {key: (old, new)}, in place
+    for key, (old, new) in delta.items():
+        if reverse:
+            old, new = new, old
+        if new is None:
+            state.pop(key, None)
+        else:
+            state[key] = new
+    return state
+
+def invert(delta):
+    return {key: (new, old) for key, (old, new) in delta.items()}
+
+def record_size(record):
+    #bytes held by a record and the tuples in it, names and numbers are shared and not counted
+    size = sys.getsizeof(record)
+    for item in record:
+        if type(item) is tuple:
+            size += record_size(item)
+    return size
+
+def delta_size(delta):
+    #old records were counted with the delta that created them
+    size = sys.getsizeof(delta)
+    for old, new in delta.values():
+        size += sys.getsizeof((old, new))
+        if new is not None:
+            size += record_size(new)
+    return size
+
 class Caretaker:
-    def __init__(self):
-        self.history = []
+    """Undo history kept as deltas between circuit states.
+
+    Undo and redo carry the current state across one delta. Once the deltas
+    hold more than max_bytes of records the oldest ones are dropped, each
+    delta is measured once when it is added.
+    """
+
+    def __init__(self, max_bytes = 32*2**20):
+        self.max_bytes = max_bytes
+        self.state = {} #state at idx
+        self.deltas = {} #index -> (delta from index-1 to index, size in bytes)
+        self.base = 0 #oldest reachable state
         self.idx = -1
+        self.top = -1 #newest state, the end of the redo history
+        self.bytes = 0
 
-    def add_snapshot(self, snapshot):
+    def add_snapshot(self, delta):
+        if not delta and self.idx >= 0:
+            return
+        self._truncate()
         self.idx += 1
-        if self.idx < len(self.history):
-            self.history = self.history[:self.idx]
-        self.history.append(snapshot)
-    
+        self.top = self.idx
+        apply(self.state, delta)
+        if self.idx > 0:
+            size = delta_size(delta)
+            self.deltas[self.idx] = (delta, size)
+            self.bytes += size
+        self._evict()
+
     def undo(self):
-        try:
-            self.idx -= 1
-            return self.restore(self.idx)
-        except IndexError:
+        """Step back one state and return the delta that leads there."""
+        if self.idx <= self.base:
             raise UndoRedoException()
+        delta, _ = self.deltas[self.idx]
+        apply(self.state, delta, reverse = True)
+        self.idx -= 1
+        return invert(delta)
 
     def redo(self):
-        try:
-            self.idx += 1
-            return self.restore(self.idx)
-
-        except IndexError as e:
+        """Step forward one state and return the delta that leads there."""
+        if self.idx >= self.top:
             raise UndoRedoException()
-        
-    def restore(self, index):
-        if index == -1:
-            raise IndexError
-        return self.history[index]
\ No newline at end of file
+        self.idx += 1
+        delta, _ = self.deltas[self.idx]
+        apply(self.state, delta)
+        return delta
+
+    def _truncate(self):
+        #a new snapshot discards the redo history
+        for i in range(self.idx+1, self.top+1):
+            _, size = self.deltas.pop(i)
+            self.bytes -= size
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.base < self.idx:
+            self.base += 1
+            _, size = self.deltas.pop(self.base)
+            self.bytes -= size
@@ -1,24 +1,75 @@
 from itertools import chain
+import numpy as np
+from numpy.linalg import matrix_power
 from sccircuitbuilder.node import Node, Ground
-from sccircuitbuilder.branch_element import BranchElement
+from sccircuitbuilder.branch_element import BranchElement, ELEMENT_TYPES
 from sccircuitbuilder.connection import Connection, Anchor, Wire
-from sccircuitbuilder.constants import Point, SPACING
+from sccircuitbuilder.constants import Point, SPACING, ROT_MAT, Bbox
+from sccircuitbuilder.spatial_index import SpatialIndex
+from sccircuitbuilder.nets import Nets
+from sccircuitbuilder.canvas_element import UIDS
+from sccircuitbuilder.exporter import export_lines
+
+PAINT_TILE = 8*SPACING #cell size of the index used to cull painting
+
+def _snapped(points):
+    return (np.rint(np.asarray(points, dtype = float)/SPACING)*SPACING).astype(int)
 
 class Circuit:
+
+    #hit-testing and painting priority, same order as __iter__
+    ELEMENT, NODE, GROUND, ANCHOR, CONNECTION = range(5)
     
     def __init__(self):
         
         self.elements = []
-        self.nodes = []
+        self.nodes = {} #node -> None, keeps insertion order and removes in O(1)
+        self._numbered = True
         self.grounds = []
         self.connections = []
         self.anchors = []
+        self.index = SpatialIndex()
+        self.paint_index = SpatialIndex(PAINT_TILE, track_changes = True)
+        self.nets = Nets(self)
+        self.objects = {} #uid -> node, ground or element
+        self.records = {} #uid -> record as of the last call to delta
+        self._dirty = set()
+        self.source = None #MappedCircuit the unbuilt objects come from
+        self._changed = None #objects changed since take_changes, None until it is first called
+        self._batch = None #objects add_batch has made, indexed once they are complete
+        self._unmapped = set() #uids of unbuilt objects of a mapped file removed by clear
+
+    def _insert(self, obj, rank):
+        if self._batch is not None:
+            self._batch.append((obj, rank))
+            return
+        self.index.insert(obj, rank, obj.hit_rects())
+        self.paint_index.insert(obj, rank, obj.paint_rects())
+        if rank in (self.ELEMENT, self.NODE, self.GROUND):
+            self.objects[obj.uid] = obj
+        elif rank == self.CONNECTION:
+            self.nets.invalidate()
+        self.mark_dirty(obj)
+
+    def _remove(self, obj):
+        self.index.remove(obj)
+        self.paint_index.remove(obj)
+        if self.objects.get(obj.uid) is obj:
+            del self.objects[obj.uid]
+            if self.source:
+                self.source.set_alive(obj.uid, False)
+        self.mark_dirty(obj)
 
     def add_element(self, element):
         self.elements.append(element)
+        self._insert(element, self.ELEMENT)
 
     def remove_element(self, element):
+        for node in element.nodes:
+            self.complete(node)
         self.elements.remove(element)
+        self._remove(element)
+        self.nets.invalidate()
         for node in element.nodes:
             if len(node.elements) == 1:
                 node.delete()
@@ -29,61 +80,314 @@ class Circuit:
     
     def add_ground(self, ground):
         self.grounds.append(ground)
+        self._insert(ground, self.GROUND)
     
     def remove_ground(self, ground):
         self.grounds.remove(ground)
+        self._remove(ground)
+        self._forget_net(ground)
     
     def remove_node(self, node):
-        self.nodes.remove(node)
-        for i,node in enumerate(self.nodes):
-            node.idx = i+1 
+        del self.nodes[node]
+        self._remove(node)
+        self._forget_net(node)
+        self._numbered = False
+
+    def _forget_net(self, node):
+        #a node that was merged away has handed over its wires and disconnects nothing
+        if node.connections:
+            self.nets.invalidate()
+        else:
+            self.nets.discard(node)
+
+    def number_nodes(self):
+        """Assign node indices if nodes were added or removed since the last call."""
+        if self._numbered:
+            return
+        self._numbered = True
+        #nodes of a mapped file come first, in file order, then the ones added since
+        source = self.source
+        i = source.alive_nodes() if source else 0
+        for node in self.nodes:
+            if source and source.owns(node.uid):
+                idx = source.node_number(node.uid)
+            else:
+                i += 1
+                idx = i
+            if node._idx != idx:
+                node._idx = idx
+                self.touch(node)
 
     def add_connection(self, connection):
         self.connections.append(connection)
+        self._insert(connection, self.CONNECTION)
     
     def remove_connection(self, connection):
         self.connections.remove(connection)
+        self._remove(connection)
+        self.nets.invalidate()
         for anchor in connection.anchors:
             self.remove_anchor(anchor)
     
     def add_node(self, node):
-        node.idx = len(self.nodes)+1
-        self.nodes.append(node)
+        self.nodes[node] = None
+        self._numbered = False
+        self._insert(node, self.NODE)
     
     def add_circuit(self, circuit):
         for elt in circuit:
             elt.circuit = self
-        self.nodes += circuit.nodes
+        self.nodes.update(circuit.nodes)
         self.elements += circuit.elements
         self.grounds += circuit.grounds
         self.connections += circuit.connections
         self.anchors += circuit.anchors
-        for i,node in enumerate(self.nodes):
-            node.idx = i+1
+        self._numbered = False
+        self.nets.invalidate()
+        for obj in circuit:
+            self._insert(obj, circuit.index.rank(obj))
     
+    def add_batch(self, names, positions, terminals, points, grounded = None, rotations = None, properties = None):
+        """Add many elements in one pass, returns the new nodes and elements.
+
+        names: type of each element, a key of ELEMENT_TYPES
+        positions: (m, 2) canvas coordinates of the elements, snapped to the grid
+        terminals: (m, 2) rows of points the two leads of each element are wired to
+        points: (n, 2) canvas coordinates of the nodes
+        grounded: (n,) which points are grounds
+        rotations: (m,) quarter turns of the elements
+        properties: per element, values overriding the defaults of its type
+
+        Nothing is recorded in between, the next delta holds the whole batch
+        as one change.
+        """
+        points = _snapped(points).reshape(-1, 2)
+        positions = _snapped(positions).reshape(-1, 2)
+        terminals = np.asarray(terminals, dtype = int).reshape(-1, 2)
+        grounded = np.zeros(len(points), dtype = bool) if grounded is None else np.asarray(grounded, dtype = bool)
+        rotations = np.zeros(len(positions), dtype = int) if rotations is None else np.asarray(rotations, dtype = int) % 4
+        properties = properties if properties is not None else [{}]*len(positions)
+        if not len(names) == len(positions) == len(terminals) == len(rotations) == len(properties):
+            raise ValueError("names, positions, terminals, rotations and properties need one row per element")
+        if len(grounded) != len(points):
+            raise ValueError("grounded needs one entry per point")
+        if len(terminals) and (terminals.min() < 0 or terminals.max() >= len(points)):
+            raise ValueError("terminals refer to points that do not exist")
+        unknown = set(names) - set(ELEMENT_TYPES)
+        if unknown:
+            raise ValueError(f"unknown element types {sorted(unknown)}")
+        for name, values in zip(names, properties):
+            if not isinstance(values, dict):
+                raise ValueError("properties needs a dict per element")
+            unknown = values.keys() - ELEMENT_TYPES[name][1].keys()
+            if unknown:
+                raise ValueError(f"{name} elements have no properties {sorted(unknown)}")
+
+        batch = self._batch = []
+        try:
+            nodes = [
+                (Ground if ground else Node)(Point(x, y), self)
+                for (x, y), ground in zip(points.tolist(), grounded.tolist())
+            ]
+            #lead directions of the two terminals for each rotation, as rotate leaves them
+            leads = [[Point(-1, 0)*matrix_power(ROT_MAT, rot), Point(1, 0)*matrix_power(ROT_MAT, rot)] for rot in range(4)]
+            elements = []
+            for name, (x, y), ends, rot, values in zip(names, positions.tolist(), terminals.tolist(), rotations.tolist(), properties):
+                element = BranchElement(Point(x, y), self, handles = False)
+                element.set_type(name)
+                element.properties.update(values)
+                #placed in its final orientation, its wires are routed once below
+                element.rot = rot
+                if rot % 2:
+                    element.bbox = Bbox(element.bbox.height, element.bbox.width)
+                for end, d in zip(ends, leads[rot]):
+                    node = nodes[end]
+                    element.nodes.append(node)
+                    node.elements.append(element)
+                    self._connect(element, node, Point(int(d.x), int(d.y)), [])
+                elements.append(element)
+        except BaseException:
+            #a batch is added whole or not at all
+            self._unlist(obj for obj, _ in batch)
+            raise
+        finally:
+            self._batch = None
+        for obj, rank in batch:
+            self._insert(obj, rank)
+        return nodes, elements
+
+    def _unlist(self, objects):
+        #take objects that were never indexed out of the lists, in one pass per list
+        objects = set(objects)
+        for obj in objects & self.nodes.keys():
+            del self.nodes[obj]
+        for objs in (self.elements, self.grounds, self.connections, self.anchors):
+            objs[:] = [obj for obj in objs if not obj in objects]
+
     def add_anchor(self, anchor):
         self.anchors.append(anchor)
+        self._insert(anchor, self.ANCHOR)
 
     def remove_anchor(self, anchor):
         self.anchors.remove(anchor)
+        self._remove(anchor)
+
+    def reindex(self, obj):
+        #called whenever an object moves or its wires are rerouted
+        if obj in self.index:
+            self.index.update(obj, obj.hit_rects())
+            self.paint_index.update(obj, obj.paint_rects())
+            self.mark_dirty(obj)
+
+    def touch(self, obj):
+        #called when an object looks different without having moved, its labels may have grown
+        if obj in self.paint_index.entries:
+            self.paint_index.update(obj, obj.paint_rects())
+        self.mark_dirty(obj)
+
+    def mark_dirty(self, obj):
+        owner = obj.record_owner()
+        self._dirty.add(owner)
+        if self._changed is not None:
+            self._changed.add(owner)
+
+    def take_changes(self):
+        """Nodes and elements changed since the last call, None if everything may have changed."""
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def state(self):
+        """Records of every object, keyed by uid."""
+        nodes, grounds, elements = self.ordered_records()
+        return dict(nodes + grounds + elements)
+
+    def ordered_records(self):
+        """(uid, record) pairs of the nodes, grounds and elements, each in uid order."""
+        #changes since the last delta are read without taking them from the undo history
+        records = dict(self.records)
+        for obj in self._dirty:
+            if self.objects.get(obj.uid) is obj:
+                records[obj.uid] = obj.record()
+            elif not obj.uid in self.objects:
+                records.pop(obj.uid, None)
+        for uid in self._unmapped:
+            records.pop(uid, None)
+        if self.source:
+            records.update(self.source.unbuilt_records())
+        ordered = {"node": [], "ground": [], "element": []}
+        for uid in sorted(records):
+            ordered[records[uid][0]].append((uid, records[uid]))
+        return ordered["node"], ordered["ground"], ordered["element"]
+
+    def delta(self):
+        """Records changed since the last call, as {key: (old, new)}. Absent records are None."""
+        changes = {}
+        #a rebuilt object may share its uid with a removed one
+        for uid in {obj.uid for obj in self._dirty} | self._unmapped:
+            obj = self.objects.get(uid)
+            self._change(changes, uid, obj.record() if obj else None)
+        self._dirty.clear()
+        self._unmapped.clear()
+        return changes
+
+    def _change(self, changes, key, new):
+        old = self.records.get(key)
+        if old == new:
+            return
+        changes[key] = (old, new)
+        if new is None:
+            del self.records[key]
+        else:
+            self.records[key] = new
+
+    def object_under(self, point, skip_obj = None):
+        for obj in self.index.at(point):
+            if obj is skip_obj:
+                continue
+            if obj.in_bbox(point):
+                return obj
+        return None
+
+    def visible(self, rect):
+        """Objects whose painted area may intersect rect, in painting order."""
+        return self.paint_index.query(rect)
 
     def __iter__(self):
         return chain(self.elements, self.nodes, self.grounds, self.anchors, self.connections)
 
+    def map(self, source):
+        """Show the objects of a MappedCircuit, building them only when they are needed."""
+        self.source = source
+        self._numbered = False
+        self._changed = None
+
+    def materialise(self, rect):
+        """Build the mapped objects that may be painted in rect."""
+        if self.source and self.source.unbuilt:
+            for uid in self.source.unbuilt_in(rect):
+                self._build(uid)
+
+    def materialise_all(self):
+        if self.source and self.source.unbuilt:
+            for uid in self.source.unbuilt_uids():
+                self._build(uid)
+
+    def complete(self, node):
+        """Build the mapped elements attached to node, before its wiring is edited."""
+        if self.source and self.source.unbuilt:
+            for uid in self.source.unbuilt_elements_of(node.uid):
+                self._build(uid)
+
+    def _build(self, uid):
+        #building is not an edit, the object enters the records as it is in the file
+        if uid in self.objects:
+            return
+        record = self.source.record(uid)
+        self.source.mark_built(uid)
+        if record[0] == "element":
+            for dep in record[7]:
+                self._build(dep)
+            for connection in record[8]:
+                self._build(connection[0])
+            self._place_element(uid, record, set())
+            #keep the wiring of the nodes in file order whatever order they are built in
+            for node in self.objects[uid].nodes:
+                node.elements.sort(key = lambda element: element.uid)
+            for connection in self.objects[uid].connections:
+                connection.dest.connections.sort(key = lambda connection: connection.origin.uid)
+        else:
+            self._place_node(uid, record)
+        obj = self.objects[uid]
+        self._dirty.discard(obj)
+        self.records[uid] = record
+
     def clear(self):
+        self._dirty.update(self.objects.values())
+        if self.source:
+            #unbuilt objects enter the records as they are in the file, so the next delta removes them like any other
+            for uid, record in self.source.unbuilt_records():
+                self.records[uid] = record
+                self._unmapped.add(uid)
+        self.objects.clear()
+        self.source = None
+        self._changed = None
+        self.nets.clear()
         self.elements.clear()
         self.nodes.clear()
         self.anchors.clear()
         self.connections.clear()
         self.grounds.clear()
+        self.index.clear()
+        self.paint_index.clear()
     
     def restore(self, memento):
         self.clear()
         self.load(memento)
 
     def load(self, memento):
-        self.node_idxs = [node.idx for node in memento.node_mementos]
-        self.ground_idxs = [ground.idx for ground in memento.ground_mementos]
+        #memento indices of the loaded nodes and grounds, the first one wins on a clash
+        self.node_ids = {}
+        self.ground_ids = {}
 
         self._load_nodes(memento)
         self._load_grounds(memento)
@@ -92,35 +396,27 @@ class Circuit:
     def _load_nodes(self, memento):
         for node_mem in memento.node_mementos:
             newnode = Node(node_mem.loc, self)
-            newnode.idx = node_mem.idx 
+            self.node_ids.setdefault(node_mem.idx, newnode)
     
     def _load_grounds(self, memento):
         for ground_mem in memento.ground_mementos:
             newground = Ground(ground_mem.loc, self)
             for i in range(ground_mem.rot):
                 newground.rotate()
+            self.ground_ids.setdefault(ground_mem.idx, newground)
 
     def _load_elements(self, memento):
         for element_mem in memento.element_mementos:
             self._load_element(element_mem)
 
     def _load_element(self, element_mem):
-        new_element = BranchElement(element_mem.loc , self)
-        new_element.icon = element_mem.icon
-        new_element.setIcon(new_element.icon, SPACING, SPACING)
+        new_element = BranchElement(element_mem.loc, self, handles = False)
+        new_element.setIcon(element_mem.icon, SPACING, SPACING)
         new_element.name = element_mem.name
         for i in range(element_mem.rot):
             new_element.rotate_icon()
         new_element.properties = element_mem.properties
 
-        for node in new_element.nodes:
-            self.remove_node(node)
-        new_element.nodes.clear()
-
-        for connection in new_element.connections:
-            self.remove_connection(connection)
-        new_element.connections.clear()
-
         self._setup_nodes(new_element, element_mem) 
         for conn_memo in element_mem.conn_memos:
             self._setup_connection(new_element, conn_memo)
@@ -128,23 +424,24 @@ class Circuit:
     
     def _setup_nodes(self, new_element, element_mem):
         for node_idx in element_mem.nodes:
-            new_element.nodes.append(self.nodes[self.node_idxs.index(node_idx)])
-            self.nodes[self.node_idxs.index(node_idx)].elements.append(new_element)
+            new_element.nodes.append(self.node_ids[node_idx])
+            self.node_ids[node_idx].elements.append(new_element)
         for gnd_idx in element_mem.grounds:
-            new_element.nodes.append(self.grounds[self.ground_idxs.index(gnd_idx)])
-            self.grounds[self.ground_idxs.index(gnd_idx)].elements.append(new_element)
+            new_element.nodes.append(self.ground_ids[gnd_idx])
+            self.ground_ids[gnd_idx].elements.append(new_element)
     
     def _setup_connection(self, new_element, conn_memo):
-        try:
-            node = self.nodes[self.node_idxs.index(conn_memo.dest)]
-            new_conn = Connection(new_element, node, conn_memo.d, self)
-            node.connections.append(new_conn)
-        except:
-            ground = self.grounds[self.ground_idxs.index(conn_memo.dest)]
-            new_conn = Connection(new_element, ground, conn_memo.d, self)
-            ground.connections.append(new_conn)
-        if conn_memo.anchors:
-            for anchor_pt in conn_memo.anchors:
+        #connections store a single index, nodes take precedence over grounds
+        node = self.node_ids.get(conn_memo.dest)
+        if node is None:
+            node = self.ground_ids[conn_memo.dest]
+        self._connect(new_element, node, conn_memo.d, conn_memo.anchors)
+
+    def _connect(self, new_element, node, d, anchors):
+        new_conn = Connection(new_element, node, d, self)
+        node.connections.append(new_conn)
+        if anchors:
+            for anchor_pt in anchors:
                 new_conn.anchors.append(Anchor(anchor_pt, self, new_conn))
             new_conn.wires[0].dest = new_conn.anchors[0]
             for i in range(len(new_conn.anchors)-1):
@@ -152,14 +449,125 @@ class Circuit:
             new_conn.wires.append(Wire(new_conn.anchors[-1], new_conn.dest, Point(0,0)))
             new_conn.rewire()
         new_element.connections.append(new_conn)
-        
+
+    def load_state(self, state):
+        """Bring the circuit to a state produced by state, keeping uids."""
+        UIDS.advance(max(state, default = 0))
+        self.delta()
+        keys = set(self.records) | set(state)
+        self.apply({
+            key: (self.records.get(key), state.get(key)) 
+            for key in keys if self.records.get(key) != state.get(key)
+        })
+
+    def apply(self, delta):
+        """Bring the circuit across a delta, rebuilding only the objects it names."""
+        changes = {key: new for key, (old, new) in delta.items()}
+        self.nets.invalidate()
+
+        detached = set()
+        removed = set()
+        for uid, record in changes.items():
+            obj = self.objects.get(uid)
+            if isinstance(obj, BranchElement) and (record is None or obj.record()[7:] != record[7:]):
+                self._detach(obj)
+                detached.add(obj)
+            if obj and record is None:
+                self._remove(obj)
+                removed.add(obj)
+
+        created = False
+        for uid, record in changes.items():
+            if record and record[0] != "element":
+                created |= self._place_node(uid, record)
+        for uid, record in changes.items():
+            if record and record[0] == "element":
+                created |= self._place_element(uid, record, detached)
+
+        if removed:
+            self.grounds[:] = [ground for ground in self.grounds if not ground in removed]
+            self.elements[:] = [element for element in self.elements if not element in removed]
+            for node in removed:
+                self.nodes.pop(node, None)
+        if created:
+            #lists are kept in creation order, which is uid order
+            nodes = sorted(self.nodes, key = lambda node: node.uid)
+            self.nodes.clear()
+            self.nodes.update(dict.fromkeys(nodes))
+            self.grounds.sort(key = lambda ground: ground.uid)
+            self.elements.sort(key = lambda element: element.uid)
+        self._numbered = False
+        self.delta()
+
+    def _detach(self, element):
+        #drop an element's wiring so that it can be rebuilt from its record
+        for connection in element.connections:
+            connection.dest.connections.remove(connection)
+            self.remove_connection(connection)
+        for node in element.nodes:
+            node.elements.remove(element)
+        element.connections.clear()
+        element.nodes.clear()
+    
+    def _adopt(self, obj, uid):
+        #give a rebuilt object the uid of the one it replaces
+        self._dirty.discard(obj)
+        del self.objects[obj.uid]
+        obj.uid = uid
+        self.objects[uid] = obj
+        if self.source:
+            self.source.set_alive(uid, True)
+        self._dirty.add(obj)
+
+    def _place_node(self, uid, record):
+        kind, x, y, rot = record
+        node = self.objects.get(uid)
+        if node is None:
+            node = (Ground if kind == "ground" else Node)(Point(x, y), self)
+            node.rot = rot
+            self._adopt(node, uid)
+            return True
+        node.x, node.y, node.rot = x, y, rot
+        node.reindex()
+        self.touch(node)
+        for connection in node.connections:
+            connection.rewire()
+        return False
+
+    def _place_element(self, uid, record, detached):
+        _, name, icon, x, y, rot, properties, terminals, connections = record
+        element = self.objects.get(uid)
+        if element is None:
+            element = BranchElement(Point(x, y), self, handles = False)
+            element.setIcon(icon, SPACING, SPACING)
+            self._adopt(element, uid)
+            detached.add(element)
+            created = True
+        else:
+            created = False
+        element.name = name
+        element.properties.clear()
+        element.properties.update(properties)
+        if (element.x, element.y) != (x, y):
+            element.x, element.y = x, y
+            element.reindex()
+        while element.rot != rot:
+            element.rotate_icon()
+        self.touch(element)
+
+        if not element in detached:
+            for connection in element.connections:
+                connection.rewire()
+            return created
+        for uid in terminals:
+            element.nodes.append(self.objects[uid])
+            self.objects[uid].elements.append(element)
+        for dest, dx, dy, anchors in connections:
+            self._connect(element, self.objects[dest], Point(dx, dy), [Point(*anchor) for anchor in anchors])
+        return created
 
     def __str__(self):
-        strs = []
-        strs.append("branches:\n")
-        for element in self.elements:
-            strs.append(str(element)+"\n")
-        return "".join(strs)
+        return "".join(export_lines(self))
 
     class CircuitMemento:
         def __init__(self, circuit):
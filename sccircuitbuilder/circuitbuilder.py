@@ -9,11 +9,11 @@ from PySide6.QtWidgets import (
     QVBoxLayout,
     QLabel,
     QFileDialog,
-    QPushButton
+    QPushButton,
+    QMessageBox
 )
-import pickle
 from PySide6.QtGui import QDrag, QIcon, QAction
-from PySide6.QtCore import Qt, QMimeData, QPoint
+from PySide6.QtCore import Qt, QMimeData, QPoint, QTimer, QSize, QEvent
 
 from pathlib import Path
 
@@ -22,7 +22,13 @@ import os
 from sccircuitbuilder.constants import *
 from sccircuitbuilder.canvas import SmartCanvas, ObjectFactory
 from sccircuitbuilder.circuit import Circuit
-from sccircuitbuilder.caretaker import Caretaker 
+from sccircuitbuilder.caretaker import Caretaker, UndoRedoException 
+from sccircuitbuilder.autosave import Autosave
+from sccircuitbuilder.exporter import Exporter
+from sccircuitbuilder.pixmap_cache import ICONS
+
+MINSIZE = QSize(1000,600)
+MODES_SHOWN = 10 #lowest normal modes listed by Tools > Normal modes
 
 class CircuitBuilder(QMainWindow):
 
@@ -35,17 +41,31 @@ class CircuitBuilder(QMainWindow):
         self.setMinimumSize(MINSIZE)
 
         self.canvas = SmartCanvas(self)
+        self.exporter = Exporter()
+        self.autosave = Autosave()
 
         self.init_toolbox()
         self.init_menu()
         self.init_toolbar()
 
-        self.caretaker = Caretaker()
-        self.take_snapshot()
+        self.reset_history()
+        self._autosave_timer = QTimer(self)
+        self._autosave_timer.timeout.connect(self.autosave_checkpoint)
+        self._autosave_timer.start(AUTOSAVE_INTERVAL)
 
         self.setCentralWidget(self.canvas)
+        #icons and the circuit library are loaded once the first frame is painted
+        self.canvas.installEventFilter(self)
         self.show()
 
+    def eventFilter(self, obj, event):
+        if obj is self.canvas and event.type() == QEvent.Type.Paint:
+            self.canvas.removeEventFilter(self)
+            QTimer.singleShot(0, self.toolsdock.load_resources)
+            if self.autosave.recoverable():
+                QTimer.singleShot(0, self.offer_recovery)
+        return super().eventFilter(obj, event)
+
     def init_toolbox(self):
         self.toolsdock = ToolDock(self.import_circuit, self.export)
         self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, self.toolsdock) 
@@ -88,6 +108,11 @@ class CircuitBuilder(QMainWindow):
         import_circuit = QAction("Import circuit", self)
         file_menu.addAction(import_circuit)
         import_circuit.triggered.connect(self.import_dialogue)
+
+        self.recover_action = QAction("Recover autosave", self)
+        file_menu.addAction(self.recover_action)
+        self.recover_action.triggered.connect(self.recover)
+        self.recover_action.setEnabled(self.autosave.recoverable())
         
 
         toolbar_menu = menu_bar.addMenu('&Tools')
@@ -97,26 +122,77 @@ class CircuitBuilder(QMainWindow):
 
         toolbar_menu.addAction(show_toolbox)
 
+        normal_modes = QAction("Normal modes", self)
+        normal_modes.triggered.connect(self.normal_modes)
+        toolbar_menu.addAction(normal_modes)
+
     def save(self, fname):
-        with open(fname, "wb") as savefile:
-            save = Circuit.CircuitMemento(self.canvas.objects)
-            pickle.dump(save, savefile)
+        from sccircuitbuilder import fileformat #file io is not needed to start up
+        #the autosave worker may be reading rows of the mapped file that the save replaces
+        self.autosave.flush()
+        fileformat.write(self.canvas.objects, fname)
     
     def open(self, fname):
-        with open(fname, "rb") as openfile:
-            saved = pickle.load(openfile)
-            self.canvas.restore(saved)
+        self.canvas.open(fname)
+        self.reset_history()
+
+    def reset_history(self):
+        #objects of a mapped file only enter the history once built, earlier states are dropped
+        self.caretaker = Caretaker()
+        self.caretaker.add_snapshot(self.canvas.objects.delta())
+        self.autosave.checkpoint(self.caretaker.state, self.canvas.objects.source)
 
     def take_snapshot(self):
-        self.caretaker.add_snapshot(Circuit.CircuitMemento(self.canvas.objects))
+        delta = self.canvas.objects.delta()
+        self.caretaker.add_snapshot(delta)
+        self.autosave.journal(delta)
+
+    def autosave_checkpoint(self):
+        error = self.autosave.failure()
+        if error:
+            QMessageBox.warning(self, "Autosave", f"Autosave failed, it is tried again with the next edits: {error}")
+        if self.autosave.changes:
+            self.autosave.checkpoint(self.caretaker.state, self.canvas.objects.source)
+
+    def recover(self):
+        state = self.autosave.recover()
+        if state is not None:
+            self.canvas.recover(state)
+            self.reset_history()
+        self.recover_action.setEnabled(self.autosave.recoverable())
+
+    def offer_recovery(self):
+        answer = QMessageBox.question(
+            self,
+            "Recover autosave",
+            "A previous session did not exit normally. Recover its circuit?",
+        )
+        if answer == QMessageBox.StandardButton.Yes:
+            self.recover()
+        else:
+            #declined, the files are not offered again
+            self.autosave.discard()
+            self.recover_action.setEnabled(False)
+
+    def closeEvent(self, event):
+        self.autosave.close()
+        super().closeEvent(event)
 
     def redo(self):
-        snapshot = self.caretaker.redo()
-        self.canvas.restore(snapshot)
+        try:
+            delta = self.caretaker.redo()
+        except UndoRedoException:
+            return
+        self.canvas.apply(delta)
+        self.autosave.journal(delta)
     
     def undo(self):
-        snapshot = self.caretaker.undo()
-        self.canvas.restore(snapshot)
+        try:
+            delta = self.caretaker.undo()
+        except UndoRedoException:
+            return
+        self.canvas.apply(delta)
+        self.autosave.journal(delta)
     
     def save_dialogue(self):
         fname, _ = QFileDialog.getSaveFileName(
@@ -128,7 +204,10 @@ class CircuitBuilder(QMainWindow):
         if fname:
             if not fname.lower().endswith(".circuit"):
                 fname += ".circuit"
-            self.save(fname)
+            try:
+                self.save(fname)
+            except OSError as e:
+                QMessageBox.warning(self, "Save File", str(e))
 
     def open_dialogue(self):
         fname,_ = QFileDialog.getOpenFileName(
@@ -137,7 +216,12 @@ class CircuitBuilder(QMainWindow):
                 "./",
                 "circuits (*.circuit)"
             )
-        self.open(fname)
+        if not fname:
+            return
+        try:
+            self.open(fname)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Open File", str(e))
     
     def export(self):
         fname,_ = QFileDialog.getSaveFileName(
@@ -147,7 +231,17 @@ class CircuitBuilder(QMainWindow):
                 "ScQubits circuit (*.yml)",
             )
         with open(fname+".yml", "w") as f:
-            f.write(str(self.canvas.objects))
+            self.exporter.write(self.canvas.objects, f)
+
+    def normal_modes(self):
+        from sccircuitbuilder import analysis
+        try:
+            frequencies = analysis.normal_modes(self.canvas.objects, k = MODES_SHOWN)
+        except ValueError as e:
+            QMessageBox.warning(self, "Normal modes", str(e))
+            return
+        text = "\n".join(f"{i+1}: {f:.4g}" for i, f in enumerate(frequencies.tolist()))
+        QMessageBox.information(self, "Normal modes", text or "The circuit has no modes.")
 
     def import_dialogue(self):
         fname,_ = QFileDialog.getOpenFileName(
@@ -156,15 +250,19 @@ class CircuitBuilder(QMainWindow):
                 "./",
                 "circuits (*.circuit)"
             )
-        self.import_circuit(fname)
+        if fname:
+            self.import_circuit(fname)
      
     def import_circuit(self, fname):
-        with open(fname, "rb") as openfile:
-            saved = pickle.load(openfile)
-            new_circuit = Circuit()
-            new_circuit.load(saved)
-            self.canvas.import_circuit(new_circuit)
-            self.take_snapshot()
+        from sccircuitbuilder import fileformat
+        new_circuit = Circuit()
+        try:
+            fileformat.load(fname, new_circuit)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Import circuit", str(e))
+            return
+        self.canvas.import_circuit(new_circuit)
+        self.take_snapshot()
 
 class ToolDock(QDockWidget):
     
@@ -175,9 +273,12 @@ class ToolDock(QDockWidget):
         toolbox.setLayout(self._layout)
         self.setWidget(toolbox)
 
+        self._import_circuit = import_circuit
+        self._labels = []
         self._elements()
         self._nodes()
-        self._circuits(import_circuit)
+        self._circuits_label = QLabel("Circuits")
+        self._layout.addWidget(self._circuits_label)
         self._gui_options(export_circuit)
 
         self._layout.addSpacerItem(QSpacerItem(
@@ -213,6 +314,7 @@ class ToolDock(QDockWidget):
         self._layout.addWidget(add_capacitor)
         self._layout.addWidget(add_inductor)
         self._layout.addWidget(add_junction)
+        self._labels += [add_capacitor, add_inductor, add_junction]
 
     def _nodes(self):
         section_label = QLabel("Nodes")
@@ -225,15 +327,21 @@ class ToolDock(QDockWidget):
         )
         self._layout.addWidget(section_label)
         self._layout.addWidget(add_ground)
+        self._labels.append(add_ground)
 
-    def _circuits(self, import_circuit):
-        section_label = QLabel("Circuits")
-        self._layout.addWidget(section_label)
+    def load_resources(self):
+        #rasterise the icons and list the circuit library once the window is up
+        for label in self._labels:
+            label.load_icon()
+        self._circuits()
+
+    def _circuits(self):
         circuits_dir = Path(__file__).parent / "circuits"
-        for entry in circuits_dir.iterdir():
+        position = self._layout.indexOf(self._circuits_label)+1
+        for i, entry in enumerate(sorted(circuits_dir.glob("*.circuit"))):
             add_circuit = QPushButton(entry.stem)
-            add_circuit.clicked.connect(CircuitImport(entry.name, import_circuit))
-            self._layout.addWidget(add_circuit)
+            add_circuit.clicked.connect(CircuitImport(entry.name, self._import_circuit))
+            self._layout.insertWidget(position+i, add_circuit)
     
     def _gui_options(self, export):
         section_label = QLabel("Gui Options")
@@ -262,12 +370,19 @@ class DragLabel(QLabel):
     def __init__(self, text, element, icon_path, icon_width, icon_height):
         super().__init__(text)
         self.element = element
-        self.icon = QIcon(icon_path).pixmap(icon_width, icon_height)
-        self.setPixmap(self.icon)
+        self.icon_path = icon_path
+        self.icon_size = (icon_width, icon_height)
+        self.icon = None
         self.setMaximumWidth(icon_width)
         self.center = QPoint(icon_width/2, icon_width/4)
     
+    def load_icon(self):
+        self.icon = ICONS.get(self.icon_path, 0, *self.icon_size, self.devicePixelRatioF())
+        self.setPixmap(self.icon)
+
     def mouseMoveEvent(self, event):
+        if self.icon is None:
+            self.load_icon()
         if event.buttons() == Qt.MouseButton.LeftButton:
             mime_data = QMimeData()
             mime_data.setText(self.element)
@@ -1,9 +1,6 @@
 from sccircuitbuilder.constants import *
 from sccircuitbuilder.canvas_element import CanvasElement
-from PySide6.QtGui import QPen, QColorConstants, QAction, QIcon
 import numpy as np
-from PySide6.QtWidgets import QToolBar, QWidget, QSizePolicy, QPushButton
-import os
 
 class Connection(CanvasElement):
 
@@ -19,17 +16,11 @@ class Connection(CanvasElement):
         self.circuit = circuit
         self.selected_anchor = None
         self.selected_wire = None
-        self.circuit.add_connection(self)
         self.disps = []
 
         self.wires.append(Wire(origin, dest, displacement))
+        self.circuit.add_connection(self)
             
-    def paint(self, painter):
-        for anchor in self.anchors:
-            anchor.paint(painter)
-        for wire in self.wires:
-            wire.paint(painter)
-
     def in_bbox(self, point):
         for anchor in self.anchors:
             if anchor.in_bbox(point):
@@ -42,6 +33,23 @@ class Connection(CanvasElement):
                 return True
         self.selected_wire = None
         return False    
+
+    def attached(self):
+        return self.anchors
+
+    def hit_rects(self):
+        rects = []
+        for anchor in self.anchors:
+            rects += anchor.hit_rects()
+        for wire in self.wires:
+            rects += wire.hit_rects()
+        return rects
+
+    def paint_rects(self):
+        rects = []
+        for wire in self.wires:
+            rects += wire.paint_rects()
+        return rects
     
     def press(self, point):
         if not self.selected_anchor:
@@ -54,17 +62,47 @@ class Connection(CanvasElement):
             self.rewire()
 
     def rewire(self):
-        for wire in self.wires:
-            wire.rewire()
+        changed = [wire.rewire() for wire in self.wires]
+        if any(changed):
+            self.reindex()
 
     def change_dest(self, newdest):
         self.dest = newdest
         self.wires[-1].dest = newdest
+        self.circuit.mark_dirty(self)
+        self.rewire()
+
+    def record_owner(self):
+        return self.origin
+
+    def path(self):
+        #anchors in order from origin to dest
+        anchors = []
+        wire = self.wires[0]
+        while True:
+            if wire.dest in self.anchors:
+                anchors.append(wire.dest)
+            for newwire in self.wires:
+                if newwire.origin is wire.dest:
+                    wire = newwire
+                    break
+            else:
+                break
+        return anchors
+
+    def record(self):
+        d = self.wires[0].d
+        return (
+            self.dest.uid, 
+            int(d.x), 
+            int(d.y), 
+            tuple((int(anchor.x), int(anchor.y)) for anchor in self.path())
+        )
 
     def reorient(self):
         wire = self.wires[0]
         wire.d = wire.d * ROT_MAT
-        wire.rewire()
+        self.rewire()
 
     def remove_anchor(self, anchor):
         head = None
@@ -78,28 +116,12 @@ class Connection(CanvasElement):
         self.circuit.remove_anchor(anchor)
         self.wires.remove(tail)
         head.dest = tail.dest
+        self.rewire()
 
-    def toolbar(self, update):
-        if self.selected_anchor:
-            return self.selected_anchor.toolbar(update)
-        else:
-            return QToolBar()
-    
     class ConnectionMomento:
         def __init__(self, connection):
             self.dest = connection.dest.idx
-            self.anchors = []
-            wire = connection.wires[0]
-            while True: #add anchors in path order
-                if wire.dest in connection.anchors:
-                    self.anchors.append(Point(wire.dest.x, wire.dest.y))
-                for newwire in connection.wires:
-                    if newwire.origin is wire.dest:
-                        wire = newwire
-                        break
-                else:
-                    break
-                    
+            self.anchors = [Point(anchor.x, anchor.y) for anchor in connection.path()]
             self.d = connection.wires[0].d
 
 
@@ -109,14 +131,14 @@ class Wire(CanvasElement):
         self.origin = origin
         self.dest = dest
         self.d = d
-        self.links = []
-        self.selected_link = None
+        self.corners = []
+        self.rects = []
         self.orientation = 0
+        self.key = None
         self.rewire()
     
     def rewire(self):
-        self.links.clear()
- 
+        #only reroute when an endpoint or the handle direction has changed
         oy = round(self.origin.y/SPACING)
         oy += self.d.y
 
@@ -126,6 +148,11 @@ class Wire(CanvasElement):
 
         tx,ty = round(self.dest.x/SPACING), round(self.dest.y/SPACING)
 
+        key = (ox, oy, tx, ty, self.d.x, self.d.y)
+        if key == self.key:
+            return False
+        self.key = key
+
         self.orientation = 0
         if self.d.x:
             if (ox < tx and self.d.x < 0) or (ox > tx and self.d.x > 0):
@@ -136,66 +163,60 @@ class Wire(CanvasElement):
                 self.orientation = 1
 
         self.wire(ox, oy, tx, ty)
+        return True
 
 
     def wire(self, ox, oy, tx, ty):
-        
-        def linkx(sy): 
-            disp = int(tx > ox)*2-1
-            for x in range(ox, tx, disp):
-                self.links.append(Link(x,sy))
-
-        def linky(sx): 
-            disp = int(ty > oy)*2-1
-            for y in range(oy, ty, disp):
-                self.links.append(Link(sx,y))
-
+        #a wire is at most two orthogonal segments meeting at one corner
         if self.orientation == 0:
-            linkx(oy)
-            linky(tx)
+            corner = (tx, oy)
         else:
-            linky(ox)
-            linkx(ty)
-
+            corner = (ox, ty)
+
+        self.corners = [(ox, oy)]
+        for point in (corner, (tx, ty)):
+            if point != self.corners[-1]:
+                self.corners.append(point)
+
+        #clickable area covers the grid cells along the wire except its two ends
+        self.rects = []
+        last = len(self.corners)-2
+        for i in range(last+1):
+            (x0, y0), (x1, y1) = self.corners[i], self.corners[i+1]
+            dx, dy = int(x1 > x0)-int(x1 < x0), int(y1 > y0)-int(y1 < y0)
+            if i == 0:
+                x0, y0 = x0+dx, y0+dy
+            if i == last:
+                x1, y1 = x1-dx, y1-dy
+            if (x1-x0)*dx < 0 or (y1-y0)*dy < 0:
+                continue
+            self.rects.append(Rect(
+                (min(x0, x1)-.5)*SPACING,
+                (min(y0, y1)-.5)*SPACING,
+                (max(x0, x1)+.5)*SPACING,
+                (max(y0, y1)+.5)*SPACING
+            ))
             
-    def paint(self, painter):
-        self.rewire()
-        pen = QPen(QColorConstants.Black, 2)
-        painter.setPen(pen)
-
-        if len(self.links) == 0:
-            return
-        link2 = None
-        for i in range(len(self.links)-1):
-            link1 = self.links[i] 
-            link2 = self.links[i+1] 
-
-            painter.drawLine(link1.x*SPACING, link1.y*SPACING, link2.x*SPACING, link2.y*SPACING)
-            
-        painter.drawLine(self.links[-1].x*SPACING, self.links[-1].y*SPACING, self.dest.x, self.dest.y)
+    def hit_rects(self):
+        return self.rects
+
+    def paint_rects(self):
+        rects = []
+        for (x0, y0), (x1, y1) in zip(self.corners, self.corners[1:]):
+            rects.append(Rect(
+                (min(x0, x1)-.5)*SPACING,
+                (min(y0, y1)-.5)*SPACING,
+                (max(x0, x1)+.5)*SPACING,
+                (max(y0, y1)+.5)*SPACING
+            ))
+        return rects
 
     def in_bbox(self, point):
-        for link in self.links[1:]:
-            if link.in_bbox(point):
-                self.selected_link = link
+        for rect in self.rects:
+            if rect.left < point.x < rect.right and rect.top < point.y < rect.bottom:
                 return True
         return False
 
-class Link:
-    
-    def __init__(self, x, y): 
-        self.x = x
-        self.bbox = Bbox(SPACING, SPACING)
-        self.y = y
-    
-    def in_bbox(self, point):
-        sx = self.x*SPACING
-        sy = self.y*SPACING
-        if (point.x > sx-self.bbox.width/2 and point.x < sx + self.bbox.width/2 \
-            and point.y > sy-self.bbox.height/2 and point.y < sy+self.bbox.height/2):
-            return self
-        return None
-
 
 class Anchor(CanvasElement):
 
@@ -203,28 +224,24 @@ class Anchor(CanvasElement):
 
     def __init__(self, point, circuit, connection):
         super().__init__(point)
-        circuit.add_anchor(self)
+        self.circuit = circuit
         self.connection = connection
-
-    def paint(self, painter):
-        painter.setPen(QPen(QColorConstants.Black, 1))
-        painter.drawEllipse(self.x-5, self.y-5, 10,10)
+        circuit.add_anchor(self)
 
     def in_bbox(self, point):
         if super().in_bbox(point):
             return self
         return None
+
+    def attached(self):
+        return [self.connection]
+
+    def record_owner(self):
+        return self.connection.origin
+
+    def drag(self, point):
+        super().drag(point)
+        self.connection.rewire()
     
     def delete(self):
         self.connection.remove_anchor(self)
-
-    def toolbar(self, update):
-        toolbar = QToolBar()
-        delete = QAction("",toolbar)
-        delete.setIcon(QIcon(os.path.join(os.path.dirname(__file__),"icons/trash")))
-        def deleteandupdate():
-            self.delete()
-            update()
-        delete.triggered.connect(deleteandupdate)
-        toolbar.addAction(delete)
-        return toolbar
@@ -1,6 +1,4 @@
 from collections import namedtuple
-from PySide6.QtCore import QSize 
-from PySide6.QtGui import QColorConstants
 import numpy as np
 
 class Point:
@@ -30,20 +28,24 @@ class Point:
         return Point(round(self.x/SPACING)*SPACING, round(self.y/SPACING)*SPACING)
 
 SPACING =  50
-BGCOLOR = QColorConstants.White
 NODE_SIZE = 6
 ZOOM_SPEED = .001
+MOVE_INTERVAL = 16 #ms between processed mouse moves, about one frame at 60 Hz
+AUTOSAVE_INTERVAL = 30000 #ms between autosave checkpoints, edits in between are journaled
 POINT_SIZE = 4
 WIRE_SIZE = 3
 MAX_ZOOM = 5
 MIN_ZOOM = .3
+GRID_MIN_SPACING = 16 #on-screen grid spacing in pixels below which the grid coarsens
 DEFAULT_WIDTH = 800
 DEFAULT_HEIGHT = 600
 FONTSIZE = 10
 IMG_RES_FACTOR = 5
+LABEL_LINE = 1.5*FONTSIZE #spacing of the property labels of an element
+CHAR_WIDTH = FONTSIZE #bound on the mean glyph width of the label font, for culling
 ICON_SIZE = 100
-MINSIZE = QSize(1000,600)
 ORIGIN = Point(0,0)
 ROT_MAT = [[0,-1],[1,0]]
 
-Bbox = namedtuple("Bbox", ("width", "height"))
\ No newline at end of file
+Bbox = namedtuple("Bbox", ("width", "height"))
+Rect = namedtuple("Rect", ("left", "top", "right", "bottom"))
@@ -0,0 +1,76 @@
+"""Export to the scQubits YAML circuit format."""
+import numpy as np
+from sccircuitbuilder.branch_element import BranchElement, export_line
+
+HEADER = "branches:\n"
+
+def element_line(element):
+    nodes = (element.nodes[0]._idx, element.nodes[1]._idx)
+    return export_line(element.name, nodes, element.properties.values())+"\n"
+
+def export_lines(circuit):
+    """Lines of the export of a circuit, in element order."""
+    circuit.number_nodes()
+    lines = {element.uid: element_line(element) for element in circuit.elements}
+    if circuit.source:
+        #unbuilt elements of a mapped file are exported from its arrays
+        uids, numbers = circuit.source.terminal_numbers()
+        for uid, nodes in zip(uids.tolist(), numbers.tolist()):
+            lines[uid] = circuit.source.export_line(uid, nodes)+"\n"
+    return [HEADER] + [lines[uid] for uid in sorted(lines)]
+
+class Exporter:
+    """Streams the export of a circuit to a file, reusing the lines of unchanged elements.
+
+    The circuit reports the nodes and elements that changed since the last
+    export. Only the lines of those elements, and of the elements on those
+    nodes, are formatted again. Changes are taken from the circuit, so it
+    should have a single Exporter.
+    """
+
+    def __init__(self):
+        self.circuit = None
+        self._lines = {} #uid -> line
+        self._rows = None #uids and node numbers of the unbuilt rows of a mapped file
+
+    def write(self, circuit, f):
+        f.writelines(self.lines(circuit))
+
+    def lines(self, circuit):
+        circuit.number_nodes() #reports the nodes whose number changed
+        changes = circuit.take_changes()
+        if changes is None or circuit is not self.circuit:
+            self.circuit = circuit
+            self._lines.clear()
+            self._rows = None
+            changes = circuit.elements
+
+        stale = set()
+        for obj in changes:
+            stale.add(obj.uid)
+            stale.update(element.uid for element in getattr(obj, "elements", ()))
+        for uid in stale:
+            element = circuit.objects.get(uid)
+            if isinstance(element, BranchElement):
+                self._lines[uid] = element_line(element)
+            else:
+                self._lines.pop(uid, None)
+
+        source = circuit.source
+        if source:
+            #rows do not change, only the numbers of their nodes when nodes of the file are removed
+            uids, numbers = source.terminal_numbers()
+            changed = np.ones(len(uids), dtype = bool)
+            if self._rows and len(self._rows[0]):
+                #uids come in increasing order, look up each row among the previous ones
+                old_uids, old_numbers = self._rows
+                at = np.minimum(np.searchsorted(old_uids, uids), len(old_uids)-1)
+                changed = (old_uids[at] != uids) | (old_numbers[at] != numbers).any(axis = 1)
+            for i in np.flatnonzero(changed).tolist():
+                uid = int(uids[i])
+                self._lines[uid] = source.export_line(uid, numbers[i].tolist())+"\n"
+            self._rows = (uids, numbers)
+
+        yield HEADER
+        for uid in sorted(self._lines):
+            yield self._lines[uid]
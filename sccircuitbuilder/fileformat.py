@@ -0,0 +1,404 @@
+"""Binary .circuit files.
+
+A file is a fixed header, a table of sections and the sections themselves:
+packed little-endian int32 arrays for the geometry and topology, and a JSON
+table with the names, icons and properties of the elements. Terminals,
+connections and anchors are stored as offset arrays (CSR), so every section
+is read with a single bulk read. References to nodes are indices into the
+node array, grounds are stored as -1-index.
+
+Opening a file maps it into memory: the arrays are views of the mapping and
+a MappedCircuit builds canvas objects from them only when they are shown or
+edited.
+
+Files written before this format are pickled CircuitMementos and are
+migrated when opened.
+"""
+from collections import namedtuple
+from functools import lru_cache
+import json
+import mmap
+import os
+import pickle
+import struct
+import numpy as np
+from sccircuitbuilder.canvas_element import UIDS
+from sccircuitbuilder.branch_element import export_line, label_extent
+from sccircuitbuilder.constants import SPACING
+
+MAGIC = b"SCCB"
+VERSION = 1
+ELEMENTS_DIR = os.path.join(os.path.dirname(__file__), "elements")
+
+HEADER = struct.Struct("<4sHH6Q") #magic, version, number of sections, counts
+SECTION = struct.Struct("<QQ") #offset, length in bytes
+COUNTS = ("nodes", "grounds", "elements", "terminals", "connections", "anchors")
+ALIGN = 8
+
+#name, number of rows, columns; rows are given in terms of the header counts
+SECTIONS = (
+    ("nodes", "nodes", 3), #x, y, rot
+    ("grounds", "grounds", 3), #x, y, rot
+    ("elements", "elements", 3), #x, y, rot
+    ("terminal_offsets", "elements+1", 1),
+    ("terminals", "terminals", 1),
+    ("connection_offsets", "elements+1", 1),
+    ("connections", "connections", 3), #dest, dx, dy
+    ("anchor_offsets", "connections+1", 1),
+    ("anchors", "anchors", 2), #x, y
+    ("table", None, None), #utf-8 JSON
+)
+TOPOLOGY = ("terminal_offsets", "terminals", "connection_offsets", "connections")
+
+Header = namedtuple("Header", ("version",) + COUNTS + ("sections",))
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _rows(header, rows):
+    name, _, extra = rows.partition("+")
+    return getattr(header, name) + int(extra or 0)
+
+def _unpack(f, packing):
+    data = f.read(packing.size)
+    if len(data) < packing.size:
+        raise ValueError("truncated circuit file")
+    return packing.unpack(data)
+
+def read_header(f):
+    """Header of an open file: version, counts and {section: (offset, length)}."""
+    magic, version, n_sections, *counts = _unpack(f, HEADER)
+    if magic != MAGIC:
+        raise ValueError("not a binary circuit file")
+    if version > VERSION:
+        raise ValueError(f"circuit file version {version} is newer than this program")
+    sections = {}
+    for name, *_ in SECTIONS[:n_sections]:
+        sections[name] = _unpack(f, SECTION)
+    #sections are read from their offsets, one past the end of the file was cut off
+    f.seek(0, os.SEEK_END)
+    if any(offset+length > f.tell() for offset, length in sections.values()):
+        raise ValueError("truncated circuit file")
+    return Header(version, *counts, sections)
+
+def _read_section(f, header, name):
+    offset, length = header.sections[name]
+    f.seek(offset)
+    if name == "table":
+        return json.loads(f.read(length).decode("utf-8"))
+    _, rows, columns = next(section for section in SECTIONS if section[0] == name)
+    array = np.fromfile(f, dtype = "<i4", count = length//4)
+    return array.reshape(_rows(header, rows), columns) if columns > 1 else array
+
+def read(path, sections = None):
+    """Header and {section: array} for the named sections, all of them by default."""
+    with open(path, "rb") as f:
+        header = read_header(f)
+        names = sections or header.sections
+        return header, {name: _read_section(f, header, name) for name in names}
+
+def read_topology(path):
+    """Terminal and connection arrays only, without geometry or properties."""
+    return read(path, TOPOLOGY)
+
+def read_mapped(path):
+    """Header, {section: array} and the mapping of a file mapped into memory, the arrays are read-only views."""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    header = read_header(mapped)
+    data = {}
+    for name, rows, columns in SECTIONS:
+        offset, length = header.sections[name]
+        if name == "table":
+            data[name] = json.loads(mapped[offset:offset+length].decode("utf-8"))
+            continue
+        array = np.frombuffer(mapped, dtype = "<i4", count = length//4, offset = offset)
+        data[name] = array.reshape(_rows(header, rows), columns) if columns > 1 else array
+    return header, data, mapped
+
+def write(circuit, path):
+    nodes, grounds, elements = circuit.ordered_records()
+    ref = {uid: i for i, (uid, _) in enumerate(nodes)}
+    ref.update({uid: -1-i for i, (uid, _) in enumerate(grounds)})
+    elements = [record for _, record in elements]
+
+    terminals = [ref[uid] for record in elements for uid in record[7]]
+    connections = [conn for record in elements for conn in record[8]]
+    arrays = {
+        "nodes": [record[1:] for _, record in nodes],
+        "grounds": [record[1:] for _, record in grounds],
+        "elements": [record[3:6] for record in elements],
+        "terminal_offsets": np.cumsum([0] + [len(record[7]) for record in elements]),
+        "terminals": terminals,
+        "connection_offsets": np.cumsum([0] + [len(record[8]) for record in elements]),
+        "connections": [(ref[dest], dx, dy) for dest, dx, dy, _ in connections],
+        "anchor_offsets": np.cumsum([0] + [len(conn[3]) for conn in connections]),
+        "anchors": [anchor for conn in connections for anchor in conn[3]],
+    }
+    table = {"elements": [
+        [record[1], _icon_name(record[2]), [list(prop) for prop in record[6]]]
+        for record in elements
+    ]}
+    blobs = [np.asarray(arrays[name], dtype = "<i4").tobytes() for name, *_ in SECTIONS[:-1]]
+    blobs.append(json.dumps(table).encode("utf-8"))
+
+    counts = (len(nodes), len(grounds), len(elements), len(terminals), len(connections), len(arrays["anchors"]))
+    offset = _aligned(HEADER.size + SECTION.size*len(SECTIONS))
+    entries = []
+    for blob in blobs:
+        entries.append((offset, len(blob)))
+        offset = _aligned(offset + len(blob))
+    #written next to the file and moved over it
+    temp = path + ".tmp"
+    try:
+        with open(temp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(SECTIONS), *counts))
+            for entry in entries:
+                f.write(SECTION.pack(*entry))
+            for (offset, _), blob in zip(entries, blobs):
+                f.write(b"\0"*(offset-f.tell()))
+                f.write(blob)
+        source = circuit.source
+        if source and source.maps(path):
+            #a mapped file cannot be replaced on every platform, its unbuilt rows are read into memory
+            source.close()
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+def _aligned(offset):
+    return -(-offset//ALIGN)*ALIGN
+
+@lru_cache
+def _icon_name(path):
+    #icons shipped with the package are stored by name so files survive a reinstall
+    if os.path.dirname(os.path.abspath(path)) == ELEMENTS_DIR:
+        return os.path.basename(path)
+    return path
+
+@lru_cache
+def _icon_path(name):
+    path = os.path.join(ELEMENTS_DIR, name)
+    if not os.path.exists(path):
+        #path from another installation, fall back to our copy of the icon
+        path = os.path.join(ELEMENTS_DIR, os.path.basename(name))
+    return path
+
+def read_state(path):
+    """Records for Circuit.load_state, with fresh uids."""
+    return MappedCircuit(path).state()
+
+class MappedCircuit:
+    """Objects of a mapped file, as records built straight from its arrays.
+
+    The nodes, grounds and elements are given a block of uids in file order.
+    An object is built by the circuit when it is first shown or edited, after
+    that the circuit owns it and the file row is only consulted for export
+    and saving while the object stays unbuilt.
+    """
+
+    def __init__(self, path):
+        header, data, self._mapping = read_mapped(path)
+        self.stat = os.stat(path) #identifies the mapped file after it is moved or deleted
+        self.data = data
+        self.table = data["table"]["elements"]
+        self.n_nodes = header.nodes
+        self.n_grounds = header.grounds
+        self.n_points = header.nodes + header.grounds
+        self.size = self.n_points + header.elements
+        self.base = UIDS.reserve(self.size)
+        self.alive = np.ones(self.size, dtype = bool)
+        self.built = np.zeros(self.size, dtype = bool)
+        self.unbuilt = self.size
+        self._ranks = None
+        self._by_point = None
+
+        #positions of the nodes and grounds, and a bounding box of each element
+        #covering its terminals, wires and labels, for culling unbuilt objects
+        self.points = np.concatenate([data["nodes"][:, :2], data["grounds"][:, :2]])
+        elements = data["elements"]
+        xy = np.concatenate([elements[:, :2], elements[:, :2]], axis = 1)
+        lo, hi = xy[:, :2].copy(), xy[:, 2:].copy()
+        owners = self._owners("terminal_offsets")
+        terminal_xy = self.points[self._point_index(data["terminals"])]
+        connection_owners = self._owners("connection_offsets")
+        dest_xy = self.points[self._point_index(data["connections"][:, 0])]
+        anchor_owners = connection_owners[np.repeat(
+            np.arange(len(connection_owners)), np.diff(data["anchor_offsets"])
+        )]
+        for owner, points in ((owners, terminal_xy), (connection_owners, dest_xy), (anchor_owners, data["anchors"])):
+            np.minimum.at(lo, owner, points)
+            np.maximum.at(hi, owner, points)
+        #same margins as the paint rects: leads and node labels, and the property labels
+        #above and to the right of the element
+        extents = np.array([label_extent(properties) for _, _, properties in self.table]).reshape(-1, 2)
+        lo = np.minimum(lo-SPACING, elements[:, :2]+[0, -SPACING/2]-[0, 1]*extents)
+        hi = np.maximum(hi+SPACING, elements[:, :2]+[SPACING/2, 0]+[1, 0]*extents)
+        self.bounds = np.concatenate([lo, hi], axis = 1)
+
+    def maps(self, path):
+        """Whether path is the file that is mapped, even if that was moved since."""
+        try:
+            return os.path.samestat(self.stat, os.stat(path))
+        except OSError:
+            return False
+
+    def close(self):
+        """Copy the arrays out of the mapping and close it, the rows stay readable."""
+        if self._mapping is None:
+            return
+        self.data = {name: np.array(array) if isinstance(array, np.ndarray) else array for name, array in self.data.items()}
+        self._mapping.close()
+        self._mapping = None
+
+    def _owners(self, offsets):
+        #element of each row of a CSR section
+        offsets = self.data[offsets]
+        return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+    def _point_index(self, refs):
+        #node references of the file to rows of self.points
+        return np.where(refs >= 0, refs, self.n_nodes-1-refs)
+
+    def _uid(self, ref):
+        return self.base + (ref if ref >= 0 else self.n_nodes-1-ref)
+
+    def owns(self, uid):
+        return 0 <= uid-self.base < self.size
+
+    def set_alive(self, uid, alive):
+        if self.owns(uid):
+            self.alive[uid-self.base] = alive
+            if uid-self.base < self.n_nodes:
+                self._ranks = None
+
+    def mark_built(self, uid):
+        self.built[uid-self.base] = True
+        self.unbuilt -= 1
+
+    def _unbuilt(self):
+        return self.alive & ~self.built
+
+    def unbuilt_uids(self):
+        return (self.base + np.flatnonzero(self._unbuilt())).tolist()
+
+    def unbuilt_in(self, rect):
+        """Uids of the unbuilt objects that may be painted in rect, nodes before elements."""
+        todo = self._unbuilt()
+        x, y = self.points[:, 0], self.points[:, 1]
+        points = todo[:self.n_points] & (x >= rect.left) & (x <= rect.right) & (y >= rect.top) & (y <= rect.bottom)
+        left, top, right, bottom = self.bounds.T
+        elements = todo[self.n_points:] & (left <= rect.right) & (right >= rect.left) & (top <= rect.bottom) & (bottom >= rect.top)
+        return (self.base + np.flatnonzero(np.concatenate([points, elements]))).tolist()
+
+    def unbuilt_elements_of(self, uid):
+        """Uids of the unbuilt elements wired to a node or ground."""
+        i = uid-self.base
+        if not 0 <= i < self.n_points:
+            return []
+        if self._by_point is None:
+            #elements of every node as a CSR table, from the terminals and the wire ends
+            data = self.data
+            points = np.concatenate([self._point_index(data["terminals"]), self._point_index(data["connections"][:, 0])])
+            owners = np.concatenate([self._owners("terminal_offsets"), self._owners("connection_offsets")])
+            order = np.argsort(points, kind = "stable")
+            offsets = np.searchsorted(points[order], np.arange(self.n_points+1))
+            self._by_point = (owners[order], offsets)
+        owners, offsets = self._by_point
+        rows = np.unique(owners[offsets[i]:offsets[i+1]]) + self.n_points
+        return (self.base + rows[self._unbuilt()[rows]]).tolist()
+
+    def alive_nodes(self):
+        return int(self._node_ranks()[-1]) if self.n_nodes else 0
+
+    def node_number(self, uid):
+        #1-based position of the node among the nodes of the file that are still there
+        return int(self._node_ranks()[uid-self.base])
+
+    def _node_ranks(self):
+        if self._ranks is None:
+            self._ranks = np.cumsum(self.alive[:self.n_nodes])
+        return self._ranks
+
+    def record(self, uid):
+        """Record of a file object, as Circuit.delta gives it."""
+        data = self.data
+        i = uid-self.base
+        if i < self.n_nodes:
+            return ("node", *data["nodes"][i].tolist())
+        if i < self.n_points:
+            return ("ground", *data["grounds"][i-self.n_nodes].tolist())
+        i -= self.n_points
+        x, y, rot = data["elements"][i].tolist()
+        name, icon, properties = self.table[i]
+        start, stop = data["terminal_offsets"][i:i+2].tolist()
+        terminals = tuple(self._uid(ref) for ref in data["terminals"][start:stop].tolist())
+        start, stop = data["connection_offsets"][i:i+2].tolist()
+        anchor_offsets = data["anchor_offsets"][start:stop+1].tolist()
+        connections = []
+        for j, (dest, dx, dy) in enumerate(data["connections"][start:stop].tolist()):
+            anchors = data["anchors"][anchor_offsets[j]:anchor_offsets[j+1]].tolist()
+            connections.append((self._uid(dest), dx, dy, tuple(map(tuple, anchors))))
+        return (
+            "element",
+            name,
+            _icon_path(icon),
+            x,
+            y,
+            rot,
+            tuple(map(tuple, properties)),
+            terminals,
+            tuple(connections),
+        )
+
+    def unbuilt_records(self):
+        return ((uid, self.record(uid)) for uid in self.unbuilt_uids())
+
+    def state(self):
+        """Records of every object of the file."""
+        return dict(self.unbuilt_records())
+
+    def terminal_numbers(self):
+        """Uids of the unbuilt elements and the numbers of their two nodes, as Circuit.number_nodes gives them."""
+        data = self.data
+        rows = np.flatnonzero(self._unbuilt()[self.n_points:])
+        #unbuilt elements only reference nodes of the file that are still there
+        numbers = np.concatenate([self._node_ranks(), np.zeros(self.n_grounds, dtype = int)])
+        first = data["terminal_offsets"][rows]
+        ends = self._point_index(data["terminals"][np.stack([first, first+1])])
+        return self.base+self.n_points+rows, numbers[ends].T
+
+    def branch(self, uid):
+        """Name and {property: value} of an element of the file."""
+        name, _, properties = self.table[uid-self.base-self.n_points]
+        return name, dict(properties)
+
+    def export_line(self, uid, nodes):
+        name, _, properties = self.table[uid-self.base-self.n_points]
+        return export_line(name, nodes, [value for _, value in properties])
+
+def migrate(memento):
+    """Bring a pickled CircuitMemento up to date, in place."""
+    for element_mem in memento.element_mementos:
+        element_mem.icon = _icon_path(element_mem.icon)
+    return memento
+
+def load(path, circuit, lazy = False):
+    """Fill an empty circuit from a .circuit file in either format.
+
+    With lazy, a binary file is mapped and its objects are built as they are shown.
+    """
+    if is_binary(path) and lazy:
+        circuit.map(MappedCircuit(path))
+    elif is_binary(path):
+        circuit.load_state(read_state(path))
+    else:
+        with open(path, "rb") as f:
+            try:
+                memento = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError):
+                raise ValueError("not a circuit file") from None
+        circuit.load(migrate(memento))
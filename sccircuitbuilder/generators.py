@@ -0,0 +1,101 @@
+"""Generators of large periodic circuits: junction chains, SQUID arrays and lattices.
+
+Each returns a new Circuit, built with Circuit.add_batch and laid out on
+the grid with its wires routed. Long chains meander over rows of cols
+cells so they stay compact on the canvas. Besides being starting points
+for designs, they are the synthetic workloads for benchmarking.
+"""
+import numpy as np
+from sccircuitbuilder.circuit import Circuit
+from sccircuitbuilder.constants import SPACING
+
+PITCH = 4*SPACING #distance between neighbouring nodes
+LATTICE_PITCH = 6*SPACING #leaves room in each cell for a shunt capacitor
+SQUID_OFFSET = 2*SPACING #distance of the junctions of a SQUID from the line between its nodes
+
+def _values(**values):
+    #properties that were given, the others keep the defaults of the element type
+    return {key: value for key, value in values.items() if value is not None}
+
+def _meander(n, cols, row_pitch):
+    #positions of n nodes along rows of cols nodes, every other row running backwards
+    k = np.arange(n)
+    row, col = k // cols, k % cols
+    col = np.where(row % 2 == 1, cols-1-col, col)
+    return np.stack([col*PITCH, row*row_pitch], axis = 1)
+
+def _links(points, a, b):
+    #midpoint of each link between points a and b, and the rotation that turns the first lead towards a
+    d = points[b]-points[a]
+    rotations = np.select([d[:, 0] > 0, d[:, 0] < 0, d[:, 1] > 0], [0, 2, 3], 1)
+    return (points[a]+points[b])/2, rotations
+
+def junction_chain(n, cols = 50, EJ = None, EC = None, grounded = True):
+    """Chain of n Josephson junctions in series, the first node grounded if grounded."""
+    points = _meander(n+1, cols, PITCH)
+    ends = np.stack([np.arange(n), np.arange(1, n+1)], axis = 1)
+    positions, rotations = _links(points, ends[:, 0], ends[:, 1])
+    circuit = Circuit()
+    circuit.add_batch(
+        ["JJ"]*n,
+        positions,
+        ends,
+        points,
+        grounded = np.arange(n+1) == 0 if grounded else None,
+        rotations = rotations,
+        properties = [_values(EJ = EJ, EC = EC)]*n,
+    )
+    return circuit
+
+def squid_array(n, cols = 25, EJ = None, EC = None, grounded = True):
+    """Array of n SQUIDs in series, each two junctions in parallel between neighbouring nodes."""
+    points = _meander(n+1, cols, 2*PITCH)
+    ends = np.stack([np.arange(n), np.arange(1, n+1)], axis = 1)
+    positions, rotations = _links(points, ends[:, 0], ends[:, 1])
+    #the junctions of a cell sit on either side of the line between its nodes,
+    #at the turns of the meander both go outside the rows to keep clear of their wires
+    vertical = (rotations % 2 == 1)[:, None]
+    outward = np.where(positions[:, :1] < points[:, :1].max(), -1, 1)
+    first = np.where(vertical, outward*[SQUID_OFFSET, 0], [0, -SQUID_OFFSET])
+    second = np.where(vertical, outward*[2*SQUID_OFFSET, 0], [0, SQUID_OFFSET])
+    circuit = Circuit()
+    circuit.add_batch(
+        ["JJ"]*2*n,
+        np.stack([positions+first, positions+second], axis = 1).reshape(-1, 2),
+        np.repeat(ends, 2, axis = 0),
+        points,
+        grounded = np.arange(n+1) == 0 if grounded else None,
+        rotations = np.repeat(rotations, 2),
+        properties = [_values(EJ = EJ, EC = EC)]*2*n,
+    )
+    return circuit
+
+def lattice(m, n, EJ = None, EC = None, C = None):
+    """m by n grid of nodes with a junction on every edge.
+
+    With C, every node is also shunted to ground by a capacitor of that value.
+    """
+    rows, cols = np.divmod(np.arange(m*n), n)
+    points = np.stack([cols*LATTICE_PITCH, rows*LATTICE_PITCH], axis = 1)
+    index = np.arange(m*n).reshape(m, n)
+    ends = np.concatenate([
+        np.stack([index[:, :-1].ravel(), index[:, 1:].ravel()], axis = 1),
+        np.stack([index[:-1].ravel(), index[1:].ravel()], axis = 1),
+    ]).reshape(-1, 2)
+    positions, rotations = _links(points, ends[:, 0], ends[:, 1])
+    names = ["JJ"]*len(ends)
+    properties = [_values(EJ = EJ, EC = EC)]*len(ends)
+    grounded = np.zeros(m*n, dtype = bool)
+    if C is not None:
+        #a vertical capacitor in the cell below and to the right of its node, clear of the junctions
+        grounds = points + [3*SPACING, 4*SPACING]
+        ends = np.concatenate([ends, np.stack([np.arange(m*n), m*n+np.arange(m*n)], axis = 1)])
+        positions = np.concatenate([positions, points + [2*SPACING, 3*SPACING]])
+        rotations = np.concatenate([rotations, np.full(m*n, 3)])
+        names += ["C"]*(m*n)
+        properties += [{"C": C}]*(m*n)
+        points = np.concatenate([points, grounds])
+        grounded = np.concatenate([grounded, np.ones(m*n, dtype = bool)])
+    circuit = Circuit()
+    circuit.add_batch(names, positions, ends, points, grounded, rotations, properties)
+    return circuit
@@ -0,0 +1,91 @@
+class Nets:
+    """Electrical nets: disjoint sets of nodes and grounds joined by merges.
+
+    Wires run from an element to one of its nodes, they put the element on
+    the net without joining nets, so the elements of each net are kept in a
+    separate map. The sets are built from the circuit on the first query and
+    kept up to date by merges, which are applied as unions. Other changes
+    (new wires, splits, deletes, undo) mark the sets stale and they are
+    rebuilt on the next query. A query only builds the mapped elements on
+    the node it is about, not the whole file.
+    """
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.clear()
+
+    def clear(self):
+        self.parent = {}
+        self.nodes = {} #root -> set of nodes and grounds in the net
+        self.elements = {} #root -> set of elements with a terminal on the net
+        self.grounds = {} #root -> number of grounds in the net
+        self.stale = True
+
+    def invalidate(self):
+        self.stale = True
+
+    def _add(self, node, ground = False):
+        self.parent[node] = node
+        self.nodes[node] = {node}
+        self.elements[node] = set()
+        self.grounds[node] = int(ground)
+
+    def discard(self, node):
+        #forget a node that was merged away, its parent link stays for the others
+        if self.stale or not node in self.parent:
+            return
+        self.nodes[self.find(node)].discard(node)
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] is not node:
+            parent[node] = parent[parent[node]] #path halving
+            node = parent[node]
+        return node
+
+    def union(self, a, b):
+        if self.stale or not (a in self.parent and b in self.parent):
+            self.stale = True
+            return
+        a, b = self.find(a), self.find(b)
+        if a is b:
+            return
+        if len(self.nodes[a])+len(self.elements[a]) < len(self.nodes[b])+len(self.elements[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.nodes[a] |= self.nodes.pop(b)
+        self.elements[a] |= self.elements.pop(b)
+        self.grounds[a] += self.grounds.pop(b)
+
+    def _rebuild(self):
+        self.clear()
+        for node in self.circuit.nodes:
+            self._add(node)
+        for ground in self.circuit.grounds:
+            self._add(ground, ground = True)
+        for connection in self.circuit.connections:
+            self.elements[self.find(connection.dest)].add(connection.origin)
+        self.stale = False
+
+    def _root(self, node):
+        self.circuit.complete(node)
+        if self.stale or not node in self.parent:
+            self._rebuild()
+        return self.find(node)
+
+    def connected(self, a, b):
+        return self._root(a) is self._root(b)
+
+    def net_nodes(self, node):
+        """Nodes and grounds on the net of node."""
+        root = self._root(node) #may rebuild the tables
+        return self.nodes[root]
+
+    def net_elements(self, node):
+        """Elements with a terminal on the net of node."""
+        root = self._root(node)
+        return self.elements[root]
+
+    def grounded(self, node):
+        root = self._root(node)
+        return self.grounds[root] > 0
@@ -1,63 +1,72 @@
 from sccircuitbuilder.canvas_element import CanvasElement
 from sccircuitbuilder.constants import *
-from math import sin, cos, pi
-from PySide6.QtGui import QPen, QColorConstants, QPolygon, QIcon, QAction
-from PySide6.QtCore import QPoint
-from PySide6.QtWidgets import QToolBar, QWidget, QSizePolicy, QPushButton
 from numpy.linalg import matrix_power
-import os
 
 GROUND_RAD = .3*SPACING
 
+def merged(a, b):
+    #extend the longer list, so merging costs the size of the smaller net
+    if len(a) < len(b):
+        a, b = b, a
+    a += b
+    return a
+
 class Node(CanvasElement):
     def __init__(self, point, circuit):
         super().__init__(point.snaptogrid())
         
-        self.idx = 0
+        self._idx = 0
         self.elements = []
         self.connections = []
         self.circuit = circuit
         self.add_to_circuit()
     
+    @property
+    def idx(self):
+        #indices follow the node order and are only reassigned when read
+        self.circuit.number_nodes()
+        return self._idx
+
+    @idx.setter
+    def idx(self, idx):
+        self._idx = idx
+
     def add_to_circuit(self):
         self.circuit.add_node(self)
 
     def drop(self, point, other):
         if not issubclass(type(other), Node):
             return
+        self.circuit.complete(self)
+        self.circuit.complete(other)
+        self.circuit.nets.union(self, other)
+        connections, elements = self.connections, self.elements
+        self.connections, self.elements = [], []
         self.circuit.remove_node(self)
-        other.connections += self.connections
-        other.elements += self.elements
-        for conn in self.connections:
+        other.connections = merged(other.connections, connections)
+        other.elements = merged(other.elements, elements)
+        for conn in connections:
             conn.change_dest(other)
-        for elem in self.elements:
+        for elem in elements:
             for i,node in enumerate(elem.nodes):
                 if node == self:
                     elem.nodes[i] = other
    
+    def attached(self):
+        return self.connections
+
     def drag(self, point):
+        self.circuit.complete(self)
         super().drag(point)
         for conn in self.connections:
             conn.rewire()
 
-    def paint(self, painter):
-        pen = QPen(QColorConstants.Black, NODE_SIZE)
-        painter.setPen(pen)
-        painter.drawText(int(self.x+FONTSIZE), int(self.y-FONTSIZE), str(self.idx))
-        painter.drawPoint(self.x, self.y)
-    
-    def toolbar(self, update):
-        toolbar = QToolBar()
-        split = QAction("",toolbar)
-        split.setIcon(QIcon(os.path.join(os.path.dirname(__file__),"icons/split")))
-        def splitandupdate():
-            self.split()
-            update()
-        split.triggered.connect(splitandupdate)
-        toolbar.addAction(split)
-        return toolbar
-    
+    def paint_rects(self):
+        #the node index is drawn above and to the right of the node
+        return [Rect(self.x-SPACING/2, self.y-SPACING/2, self.x+SPACING, self.y+SPACING/2)]
+
     def split(self):
+        self.circuit.complete(self)
         if len(self.elements) > 1:
             self.circuit.remove_node(self)
             for element in self.elements:
@@ -79,6 +88,9 @@ class Node(CanvasElement):
     def delete(self):
         self.circuit.remove_node(self)
 
+    def record(self):
+        return ("node", int(self.x), int(self.y), self.rot)
+
     class NodeMemento:
 
         def __init__(self, node):
@@ -92,38 +104,12 @@ class Ground(Node):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def toolbar(self, update):
-        toolbar = QToolBar()
-        def rotateandupdate():
-            self.rotate()
-            update()
-        rotate = QAction("",toolbar)
-        rotate.setIcon(QIcon(os.path.join(os.path.dirname(__file__), "icons/rotate")))
-        rotate.triggered.connect(rotateandupdate)
-        toolbar.addAction(rotate)
-
-        if not self.elements:
-            delete = QAction("",toolbar)
-            delete.setIcon(QIcon(os.path.join(os.path.dirname(__file__),"icons/trash")))
-            def deleteandupdate():
-                self.delete()
-                update()
-            delete.triggered.connect(deleteandupdate)
-            toolbar.addAction(delete)
-
-        return toolbar
-
     def add_to_circuit(self):
         self.circuit.add_ground(self)
 
-    def paint(self, painter):
-        painter.setPen(QPen(QColorConstants.Black, WIRE_SIZE))
-        p1 = QPoint(int(self.x+GROUND_RAD*cos(self.rot*pi/2)), int(self.y+GROUND_RAD*sin(self.rot*pi/2)))
-        p2 = QPoint(int(self.x+GROUND_RAD*sin(self.rot*pi/2)), int(self.y+GROUND_RAD*cos(self.rot*pi/2)))
-        p3 = QPoint(int(self.x-GROUND_RAD*cos(self.rot*pi/2)), int(self.y-GROUND_RAD*sin(self.rot*pi/2)))
-
-        painter.drawPolygon(QPolygon([p1,p2,p3]))
-
     def delete(self):
         self.circuit.remove_ground(self)
 
+    def record(self):
+        return ("ground", int(self.x), int(self.y), self.rot)
+
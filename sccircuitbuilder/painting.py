@@ -0,0 +1,223 @@
+"""Qt rendering of the circuit model.
+
+The model classes know nothing of Qt. Painting an object and building the
+toolbar shown while it is selected are looked up here by the object's class.
+"""
+from math import sin, cos, pi
+import os
+from PySide6.QtGui import QPen, QColorConstants, QPolygon, QIcon, QAction
+from PySide6.QtCore import QPoint
+from PySide6.QtWidgets import (
+    QToolBar,
+    QWidget,
+    QLabel,
+    QLineEdit,
+    QHBoxLayout,
+    QSpacerItem,
+    QSizePolicy,
+)
+from sccircuitbuilder.constants import *
+from sccircuitbuilder.canvas_element import CanvasElement
+from sccircuitbuilder.node import Node, Ground, GROUND_RAD
+from sccircuitbuilder.branch_element import BranchElement
+from sccircuitbuilder.connection import Connection, Wire, Anchor
+from sccircuitbuilder.pixmap_cache import ICONS
+
+BGCOLOR = QColorConstants.White
+
+def _icon(name):
+    return QIcon(os.path.join(os.path.dirname(__file__), "icons", name))
+
+def _lookup(table, obj):
+    #handlers are registered for base classes, the first match along the mro is cached
+    cls = type(obj)
+    handler = table.get(cls)
+    if handler is None:
+        handler = next(table[base] for base in cls.__mro__ if base in table)
+        table[cls] = handler
+    return handler
+
+def paint(obj, painter):
+    _lookup(PAINTERS, obj)(obj, painter)
+
+def toolbar(obj, update):
+    """Toolbar with the actions of a selected object, update is called after each one."""
+    return _lookup(TOOLBARS, obj)(obj, update)
+
+def paint_canvas_element(element, painter):
+    color = QColorConstants.Black
+    if element.active:
+        color = QColorConstants.Red
+    pen = QPen(color, 3)
+    painter.setPen(pen)
+    painter.drawRect(int(element.x-element.width/2),int(element.y-element.width/2),SPACING,SPACING)
+
+def paint_element(element, painter):
+    painter.setPen(QPen(QColorConstants.Black, 3))
+    for i, prop in enumerate(element.properties):
+        painter.drawText(int(SPACING/2+element.x), int(element.y-SPACING/2-i*LABEL_LINE), str(prop) + " = "+str(element.properties[prop]))
+
+    width = element.bbox.width
+    height = element.bbox.height
+    if element.rot % 2== 0:
+        disp = [SPACING, 0]
+    else:
+        disp = [0,SPACING]
+    icon = ICONS.get(element.icon_path, element.rot, *element.icon_size, painter.device().devicePixelRatioF())
+    painter.drawPixmap(int(element.x-width/2-disp[0]/2), int(element.y-height/2-disp[1]/2), int(width+disp[0]), int(height+disp[1]), icon)
+
+def paint_node(node, painter):
+    pen = QPen(QColorConstants.Black, NODE_SIZE)
+    painter.setPen(pen)
+    painter.drawText(int(node.x+FONTSIZE), int(node.y-FONTSIZE), str(node.idx))
+    painter.drawPoint(node.x, node.y)
+
+def paint_ground(ground, painter):
+    painter.setPen(QPen(QColorConstants.Black, WIRE_SIZE))
+    p1 = QPoint(int(ground.x+GROUND_RAD*cos(ground.rot*pi/2)), int(ground.y+GROUND_RAD*sin(ground.rot*pi/2)))
+    p2 = QPoint(int(ground.x+GROUND_RAD*sin(ground.rot*pi/2)), int(ground.y+GROUND_RAD*cos(ground.rot*pi/2)))
+    p3 = QPoint(int(ground.x-GROUND_RAD*cos(ground.rot*pi/2)), int(ground.y-GROUND_RAD*sin(ground.rot*pi/2)))
+
+    painter.drawPolygon(QPolygon([p1,p2,p3]))
+
+def paint_connection(connection, painter):
+    for anchor in connection.anchors:
+        paint_anchor(anchor, painter)
+    for wire in connection.wires:
+        paint_wire(wire, painter)
+
+def paint_wire(wire, painter):
+    if len(wire.corners) < 2:
+        return
+    pen = QPen(QColorConstants.Black, 2)
+    painter.setPen(pen)
+    painter.drawPolyline(QPolygon([QPoint(int(x*SPACING), int(y*SPACING)) for x, y in wire.corners]))
+
+def paint_anchor(anchor, painter):
+    painter.setPen(QPen(QColorConstants.Black, 1))
+    painter.drawEllipse(anchor.x-5, anchor.y-5, 10,10)
+
+def element_toolbar(element, update):
+    toolbar = QToolBar()
+    def rotateandupdate():
+        element.rotate()
+        update()
+    rotate = QAction("",toolbar)
+    rotate.setIcon(_icon("rotate"))
+    rotate.triggered.connect(rotateandupdate)
+    toolbar.addAction(rotate)
+
+    delete = QAction("",toolbar)
+    delete.setIcon(_icon("trash"))
+    def deleteandupdate():
+        element.delete()
+        update()
+    delete.triggered.connect(deleteandupdate)
+    toolbar.addAction(delete)
+
+    def touchandupdate():
+        element.circuit.touch(element)
+        update()
+    for prop in element.properties:
+        propedit = PropEdit(prop, element.properties, touchandupdate)
+        toolbar.addWidget(propedit)
+
+    spacer = QWidget()
+    spacer.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Ignored)
+    toolbar.addWidget(spacer)
+
+    return toolbar
+
+def node_toolbar(node, update):
+    toolbar = QToolBar()
+    split = QAction("",toolbar)
+    split.setIcon(_icon("split"))
+    def splitandupdate():
+        node.split()
+        update()
+    split.triggered.connect(splitandupdate)
+    toolbar.addAction(split)
+    return toolbar
+
+def ground_toolbar(ground, update):
+    toolbar = QToolBar()
+    def rotateandupdate():
+        ground.rotate()
+        update()
+    rotate = QAction("",toolbar)
+    rotate.setIcon(_icon("rotate"))
+    rotate.triggered.connect(rotateandupdate)
+    toolbar.addAction(rotate)
+
+    ground.circuit.complete(ground)
+    if not ground.elements:
+        delete = QAction("",toolbar)
+        delete.setIcon(_icon("trash"))
+        def deleteandupdate():
+            ground.delete()
+            update()
+        delete.triggered.connect(deleteandupdate)
+        toolbar.addAction(delete)
+
+    return toolbar
+
+def connection_toolbar(connection, update):
+    if connection.selected_anchor:
+        return anchor_toolbar(connection.selected_anchor, update)
+    else:
+        return QToolBar()
+
+def anchor_toolbar(anchor, update):
+    toolbar = QToolBar()
+    delete = QAction("",toolbar)
+    delete.setIcon(_icon("trash"))
+    def deleteandupdate():
+        anchor.delete()
+        update()
+    delete.triggered.connect(deleteandupdate)
+    toolbar.addAction(delete)
+    return toolbar
+
+PAINTERS = {
+    CanvasElement: paint_canvas_element,
+    BranchElement: paint_element,
+    Node: paint_node,
+    Ground: paint_ground,
+    Connection: paint_connection,
+    Wire: paint_wire,
+    Anchor: paint_anchor,
+}
+
+TOOLBARS = {
+    BranchElement: element_toolbar,
+    Node: node_toolbar,
+    Ground: ground_toolbar,
+    Connection: connection_toolbar,
+    Anchor: anchor_toolbar,
+}
+
+class PropEdit(QWidget):
+    def __init__(self, key, properties, update):
+        super().__init__()
+        self.key = key
+        self.properties = properties
+        self.update = update
+        self.initGui()
+
+    def initGui(self):
+        layout = QHBoxLayout()
+        self.setLayout(layout)
+        layout.addWidget(QLabel(self.key))
+        propedit = QLineEdit(str(self.properties[self.key]))
+        propedit.setMaximumWidth(70)
+        propedit.editingFinished.connect(self.update)
+        def textchange(text):
+            self.properties[self.key] = text
+        propedit.textChanged.connect(textchange)
+        layout.addWidget(propedit)
+        layout.addSpacerItem(QSpacerItem(
+            0,
+            0,
+            QSizePolicy.Policy.Expanding,
+            QSizePolicy.Policy.Ignored
+        ))
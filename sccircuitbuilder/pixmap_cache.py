@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from PySide6.QtCore import QSize
+from PySide6.QtGui import QIcon, QTransform
+
+MAX_BYTES = 64*1024*1024
+
+class PixmapCache:
+    """Process-wide flyweight store of rasterised icons.
+
+    Identical elements share one pixmap per (path, rotation, size, device
+    pixel ratio) instead of each rasterising and rotating its own copy. The
+    ratio is that of the device painted to, screens may differ.
+    Entries are evicted least recently used first once the cache holds
+    more than max_bytes of pixel data.
+    """
+
+    def __init__(self, max_bytes = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.pixmaps = OrderedDict() #(path, rot, width, height, ratio) -> QPixmap
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, rot, width, height, ratio):
+        key = (path, rot % 4, int(width), int(height), float(ratio))
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.hits += 1
+            self.pixmaps.move_to_end(key)
+            return pixmap
+        self.misses += 1
+        return self._render(key)
+
+    def _render(self, key):
+        #rotations are made from the upright pixmap, which is cached as well but not counted as a request
+        path, rot, width, height, ratio = key
+        if rot == 0:
+            pixmap = QIcon(path).pixmap(QSize(width, height), ratio)
+        else:
+            upright = (path, 0, width, height, ratio)
+            pixmap = self.pixmaps.get(upright)
+            if pixmap is None:
+                pixmap = self._render(upright)
+            rotatemat = QTransform()
+            rotatemat.rotate(-90*rot)
+            pixmap = pixmap.transformed(rotatemat)
+        self._put(key, pixmap)
+        return pixmap
+
+    def _put(self, key, pixmap):
+        self.pixmaps[key] = pixmap
+        self.bytes += self._size(pixmap)
+        while self.bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, old = self.pixmaps.popitem(last = False)
+            self.bytes -= self._size(old)
+            self.evictions += 1
+
+    def _size(self, pixmap):
+        return pixmap.width()*pixmap.height()*pixmap.depth()//8
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries" : len(self.pixmaps),
+            "bytes" : self.bytes,
+            "max_bytes" : self.max_bytes,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+        }
+
+ICONS = PixmapCache()
@@ -0,0 +1,130 @@
+from itertools import count
+from math import floor, ceil
+from sccircuitbuilder.constants import SPACING, Rect
+
+class SpatialIndex:
+    """Grid-keyed hash of canvas objects.
+
+    Each object is registered under every cell touched by its rectangles,
+    so a query only has to look at the objects sharing its cells. Cells are
+    centred on multiples of cell_size, matching snaptogrid for SPACING.
+    """
+
+    #beyond this many pending changes, report everything as changed
+    MAX_CHANGES = 10000
+
+    def __init__(self, cell_size = SPACING, track_changes = False):
+        self.cell_size = cell_size
+        self.cells = {} #cell -> {object: (rank, seq)}
+        self.entries = {} #object -> ((rank, seq), cells)
+        self._seq = count()
+        self.track_changes = track_changes
+        self._changes = [] #(object, cells) touched since the last take_changes
+        self._all_changed = False
+
+    def cell(self, point):
+        return (floor(point.x/self.cell_size+.5), floor(point.y/self.cell_size+.5))
+
+    def _span(self, low, high):
+        #cells overlapping the open interval (low, high)
+        first = floor(low/self.cell_size+.5)
+        last = ceil(high/self.cell_size+.5)-1
+        return range(first, max(first, last)+1)
+
+    def cell_rect(self, cell):
+        i, j = cell
+        half = self.cell_size/2
+        return Rect(i*self.cell_size-half, j*self.cell_size-half, i*self.cell_size+half, j*self.cell_size+half)
+
+    def _cells(self, rects):
+        cells = set()
+        for rect in rects:
+            for i in self._span(rect.left, rect.right):
+                for j in self._span(rect.top, rect.bottom):
+                    cells.add((i,j))
+        return cells
+
+    def insert(self, obj, rank, rects):
+        if obj in self.entries:
+            self.remove(obj)
+        key = (rank, next(self._seq))
+        cells = self._cells(rects)
+        self.entries[obj] = (key, cells)
+        for cell in cells:
+            self.cells.setdefault(cell, {})[obj] = key
+        self._changed(obj, cells)
+
+    def update(self, obj, rects):
+        key, old_cells = self.entries[obj]
+        cells = self._cells(rects)
+        for cell in old_cells - cells:
+            self._discard(cell, obj)
+        for cell in cells - old_cells:
+            self.cells.setdefault(cell, {})[obj] = key
+        self.entries[obj] = (key, cells)
+        self._changed(obj, old_cells | cells)
+
+    def remove(self, obj):
+        _, cells = self.entries.pop(obj)
+        for cell in cells:
+            self._discard(cell, obj)
+        self._changed(obj, cells)
+
+    def touch(self, obj):
+        """Record that obj looks different without having moved."""
+        if obj in self.entries:
+            self._changed(obj, self.entries[obj][1])
+
+    def _changed(self, obj, cells):
+        if not self.track_changes or self._all_changed:
+            return
+        if len(self._changes) >= self.MAX_CHANGES:
+            self._all_changed = True
+            self._changes.clear()
+        else:
+            self._changes.append((obj, cells))
+
+    def take_changes(self):
+        """(object, cells) pairs changed since the last call, or None if everything may have changed."""
+        changes = None if self._all_changed else self._changes
+        self._changes = []
+        self._all_changed = False
+        return changes
+
+    def _discard(self, cell, obj):
+        bucket = self.cells[cell]
+        del bucket[obj]
+        if not bucket:
+            del self.cells[cell]
+
+    def rank(self, obj):
+        return self.entries[obj][0][0]
+
+    def at(self, point):
+        """Objects registered in the cell under point, in priority order."""
+        bucket = self.cells.get(self.cell(point))
+        if not bucket:
+            return []
+        return sorted(bucket, key = bucket.get)
+
+    def query(self, rect):
+        """Objects registered in any cell overlapping rect, in priority order."""
+        found = {}
+        for i in self._span(rect.left, rect.right):
+            for j in self._span(rect.top, rect.bottom):
+                bucket = self.cells.get((i,j))
+                if bucket:
+                    found.update(bucket)
+        return sorted(found, key = found.get)
+
+    def clear(self):
+        self.cells.clear()
+        self.entries.clear()
+        self._changes.clear()
+        self._all_changed = self.track_changes
+
+    def __contains__(self, obj):
+        return obj in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from math import floor
+from sccircuitbuilder.constants import Rect
+
+TILE_SIZE = 256 #tile edge in device pixels
+MAX_TILES = 96 #tiles kept for the current zoom level
+
+class TileCache:
+    """Offscreen pixmaps of the static part of the canvas at one zoom level.
+
+    Tiles are laid out on a pixel grid anchored at the world origin, so
+    panning reuses them and only a zoom change discards the whole cache.
+    Tiles are evicted least recently used first.
+    """
+
+    def __init__(self, tile_size = TILE_SIZE, max_tiles = MAX_TILES):
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.zoom = None
+        self.tiles = OrderedDict() #(i, j) -> QPixmap
+
+    def reset(self, zoom):
+        self.zoom = zoom
+        self.tiles.clear()
+
+    def clear(self):
+        self.tiles.clear()
+
+    def world_rect(self, key):
+        i, j = key
+        size = self.tile_size/self.zoom
+        return Rect(i*size, j*size, (i+1)*size, (j+1)*size)
+
+    def keys(self, rect):
+        #tiles overlapping a rectangle in world coordinates
+        scale = self.zoom/self.tile_size
+        for i in range(floor(rect.left*scale), floor(rect.right*scale)+1):
+            for j in range(floor(rect.top*scale), floor(rect.bottom*scale)+1):
+                yield (i, j)
+
+    def invalidate(self, rect):
+        if not self.tiles:
+            return
+        for key in self.keys(rect):
+            self.tiles.pop(key, None)
+
+    def get(self, key):
+        pixmap = self.tiles.get(key)
+        if pixmap is not None:
+            self.tiles.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        self.tiles[key] = pixmap
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last = False)